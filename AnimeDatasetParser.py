@@ -5,6 +5,9 @@
 
 
 import pandas as pd
+import numpy as np
+import hashlib
+import os
 from collections import defaultdict
 from engine import anime
 import engine
@@ -19,6 +22,63 @@ anime_watched = "animelists_tinier.csv"
 
 chunksize = 10 ** 6
 
+# Parsed score lists are cached here as .npz files, and only parsed again when the csv files change
+# Set to None to always parse
+cache_dir = ".parse_cache"
+
+# Version of the parsed arrays, part of every cache key
+# Bump it whenever the parse code changes, so that caches written by older code are not used
+cache_version = 1
+
+# anime_cleaned.csv parsed by readAnimeTable, by cache key
+anime_tables = {}
+
+# The columns of anime_cleaned.csv read by readAnimeTable
+anime_columns = ['anime_id', 'title', 'type', 'source', 'episodes', 'rating', 'studio', 'genre', 'duration_min', 'aired_from_year']
+
+
+# Key identifying the current contents of the given files (their paths, sizes and modification times) and cache_version
+def getCacheKey(*paths):
+    key = hashlib.sha1()
+    key.update(('version %d\n' % cache_version).encode('utf-8'))
+    for path in paths:
+        st = os.stat(path)
+        key.update(('%s|%d|%d\n' % (os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return key.hexdigest()
+
+# Returns the dict of arrays built by build(), which parses the given files
+# The arrays are loaded from cache_dir instead if the files did not change since the last build
+# name tells apart the caches of different builds, only the latest cache of each name is kept
+def readCached(name, paths, build):
+    if cache_dir is None:
+        return build()
+
+    cache_file = os.path.join(cache_dir, '%s-%s.npz' % (name, getCacheKey(*paths)))
+    if os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cached:
+            return {k: cached[k] for k in cached.files}
+
+    arrays = build()
+
+    # Drop the caches of older versions of the files, then write the new one in one go
+    # The temporary file is named after the process, so that concurrent runs never write the same file,
+    # and the temporary files of other runs are left alone
+    os.makedirs(cache_dir, exist_ok=True)
+    for f in os.listdir(cache_dir):
+        if f.startswith(name + '-') and f.endswith('.npz') and not f.endswith('.tmp.npz'):
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except FileNotFoundError: # Removed by another run
+                pass
+    temp_file = '%s.%d.tmp.npz' % (cache_file, os.getpid())
+    try:
+        np.savez(temp_file, **arrays)
+        os.replace(temp_file, cache_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return arrays
+
 
 # In[3]:
 
@@ -35,12 +95,7 @@ chunksize = 10 ** 6
 # for how 
 def getAnimeList(anime_csv):
     # Reading from the anime_cleaned, the list of anime and their related data
-    anicols_to_use = ['anime_id', 'title', 'type', 'source', 'episodes', 'rating','studio','genre','duration_min','aired_from_year']
-    chunky_a = []
-    for chunk in pd.read_csv(anime_csv, index_col=1, usecols=anicols_to_use, chunksize=chunksize):
-        chunky_a.append(chunk)
-    anime_list = pd.concat(chunky_a, axis=0)
-    del chunky_a
+    anime_list = readAnimeTable(anime_csv).set_index('title')
     
     # Convert anime_list into Anime datatype
     anime_list = anime_list.T.to_dict()
@@ -74,14 +129,47 @@ def getAnimeList(anime_csv):
 # Getting a dict of id to title
 # Should pass in "anime_cleaned.csv" as that has the titles and id
 def getAnimeIdDict(anime_csv):
-    chunky_b = []
-    for chunk in pd.read_csv(anime_csv, index_col = 0, usecols=['anime_id', 'title'], chunksize=chunksize):
-        chunky_b.append(chunk)
-    anime_dict = pd.concat(chunky_b, axis=0).to_dict()
-    id_titles = anime_dict['title']
-    del chunky_b
+    id_titles = readAnimeTable(anime_csv).set_index('anime_id')['title'].to_dict()
     return id_titles
 
+# Reads the columns of anime_cleaned.csv used by getAnimeList and getAnimeIdDict
+# The parsed columns are cached, see readCached, and the table is only built once while the file does not change,
+# both functions share it
+def readAnimeTable(anime_csv):
+    key = getCacheKey(anime_csv)
+    if key not in anime_tables:
+        columns = readCached('anime_' + os.path.basename(anime_csv), [anime_csv], lambda: parseAnimeColumns(anime_csv))
+        anime_tables.clear()
+        anime_tables[key] = pd.DataFrame({name: getTableColumn(columns, name) for name in anime_columns})
+    return anime_tables[key]
+
+# Parses the columns of anime_cleaned.csv read by readAnimeTable, as a dict of arrays that can be cached without pickling
+# Text columns are stored as strings, with a '<column>_missing' mask of their empty cells
+def parseAnimeColumns(anime_csv):
+    chunky_a = []
+    for chunk in pd.read_csv(anime_csv, usecols=anime_columns, chunksize=chunksize):
+        chunky_a.append(chunk)
+    table = pd.concat(chunky_a, axis=0)
+    del chunky_a
+
+    columns = {}
+    for name in anime_columns:
+        if not pd.api.types.is_numeric_dtype(table[name]):
+            missing = table[name].isna().to_numpy()
+            columns[name] = np.array(['' if m else str(v) for v, m in zip(table[name], missing)], dtype=str)
+            columns[name + '_missing'] = missing
+        else:
+            columns[name] = table[name].to_numpy()
+    return columns
+
+# A column of the table built by readAnimeTable, from the arrays of parseAnimeColumns: empty text cells are NaN again
+def getTableColumn(columns, name):
+    if name + '_missing' not in columns:
+        return columns[name]
+    values = columns[name].astype(object)
+    values[columns[name + '_missing']] = np.nan
+    return values
+
 #
 #anime_list = pd.concat(chunky_a, axis=0)
 #del chunky_a
@@ -116,36 +204,59 @@ def getUserList(users_csv):
 # Reading in the data animelists_cleaned which details the user and anime watched
 # Gets a csv file with 'username','anime_id','scores' in anime_watch aka "animelists_cleaned.csv"
 # anime_csv has the list of corresponding anime-id and title aka "anime_cleaned.csv"
-# match the id with an anime title from anime_cleaned.csv
-# Then return a list of tuples of (username, anime_title, score)
-def getScore(anime_watch_csv, anime_csv):
+# match the id with an anime title from anime_cleaned.csv, all with vectorized operations
+# Rows with a score outside [1,10], an unknown anime_id or no username are dropped
+# Then return the scores as columns (engine.scoreColumns): usernames and titles are integer codes, scores are int8
+def getScoreColumns(anime_watch_csv, anime_csv):
+    # Parsed columns are cached, see readCached
+    columns = readCached('scores_' + os.path.basename(anime_watch_csv), [anime_watch_csv, anime_csv],
+                         lambda: parseScoreColumns(anime_watch_csv, anime_csv))
+
+    return engine.scoreColumns(columns['user_names'].tolist(), columns['user_codes'], columns['titles'].tolist(),
+                               columns['title_codes'], columns['scores'])
+
+# Parses the columns returned by getScoreColumns, as a dict of arrays
+def parseScoreColumns(anime_watch_csv, anime_csv):
     watchcols_to_use = ['username', 'anime_id', 'my_score']
-    chunky_ua = []
-    for chunk in pd.read_csv(anime_watch_csv, usecols=watchcols_to_use, chunksize=chunksize):
-        chunky_ua.append(chunk)
-    
-    users_anime_watched = pd.concat(chunky_ua, axis=0)
-    del chunky_ua
-
-    #  Pull out the columns
-    usernames  = users_anime_watched['username'].tolist()
-    ids        = users_anime_watched['anime_id'].tolist()
-    users_scores = users_anime_watched['my_score'].tolist()
 
     #get the titles to match with id
     id_titles = getAnimeIdDict(anime_csv)
-    
-     # Connect id with title
-    titles = []
-    for i in ids:
-        titles.append(id_titles[i])
-        
+    ids = pd.Index(list(id_titles.keys()))
+    titles = list(id_titles.values())
+
+    chunky_users = []
+    chunky_titles = []
+    chunky_scores = []
+    for chunk in pd.read_csv(anime_watch_csv, usecols=watchcols_to_use, dtype={'username': 'category'}, chunksize=chunksize):
+        # Connect id with title code, -1 when the id is unknown
+        title_codes = ids.get_indexer(chunk['anime_id'])
+        scores = chunk['my_score'].to_numpy()
+        usernames = chunk['username'].cat.remove_unused_categories()
+        keep = (scores >= 1) & (scores <= 10) & (title_codes >= 0) & (usernames.cat.codes.to_numpy() >= 0)
+
+        chunky_users.append(usernames[keep])
+        chunky_titles.append(title_codes[keep].astype(np.int32))
+        chunky_scores.append(scores[keep].astype(np.int8))
+
+    # Every chunk has its own username categories, so merge them into one set of codes
+    usernames = pd.api.types.union_categoricals([pd.Categorical(u) for u in chunky_users]) if chunky_users else pd.Categorical([])
+    del chunky_users
+
+    return { 'user_names': np.array([str(u) for u in usernames.categories], dtype=str),
+             'user_codes': np.asarray(usernames.codes, dtype=np.int32),
+             'titles': np.array([str(t) for t in titles], dtype=str),
+             'title_codes': np.concatenate(chunky_titles) if chunky_titles else np.zeros(0, dtype=np.int32),
+             'scores': np.concatenate(chunky_scores) if chunky_scores else np.zeros(0, dtype=np.int8) }
+
+# Same as getScoreColumns, but return a list of tuples of (username, anime_title, score)
+def getScore(anime_watch_csv, anime_csv):
+    columns = getScoreColumns(anime_watch_csv, anime_csv)
+
     # Create the tuple of scores (username [string], title [string], score [int])
-    user_scores = []
-    for i in range(0,len(usernames)):
-        if(1 <= users_scores[i] <= 10):
-            user_scores.append( (usernames[i], titles[i], users_scores[i]) )
-    
+    usernames = [columns.userNames[u] for u in columns.userCodes.tolist()]
+    titles = [columns.titleNames[t] for t in columns.titleCodes.tolist()]
+    user_scores = list(zip(usernames, titles, columns.scores.tolist()))
+
     return user_scores
     
     
@@ -158,12 +269,17 @@ def getScore(anime_watch_csv, anime_csv):
 animeList_from_csv = getAnimeList(anime_cl)
 animeList = {title:anime[0] for title, anime in animeList_from_csv.items()} # Convert 1-element lists into pure values. TEMP FIX
 
-#scoreList: list of tuples (username [string], title [string], score [int]).
+#scoreList: the scores as columns of user codes, title codes and scores (engine.scoreColumns).
 #           Score must be in the range [1,10].
-scoreList = getScore(anime_watched, anime_cl)
+scoreList = getScoreColumns(anime_watched, anime_cl)
 
-import numpy as np
-engine.initialize( animeList, scoreList )
+#anime_bins: tag the numeric fields by quantile bin rather than by exact value, see engine.binEdges.
+#            Without it every episode count, duration and start year is a tag of its own.
+anime_bins = {field: 10 for field in engine.binnedFields}
+
+engine.initialize( animeList, scoreList, bins=anime_bins )
+unbinned_tags = {tag for a in animeList.values() for tag in a.getTags()}
+print('Tags: %d with exact values, %d with bins' % (len(unbinned_tags), len(engine.tags)))
 tests = [ ( 'karthiga', 'One Piece', 9 ),
           ( 'karthiga', 'Bakuman. 2nd Season', 8 ),
           ( 'Damonashu', 'Ghost in the Shell: Stand Alone Complex - Solid State Society', 8 ),
@@ -176,9 +292,12 @@ tests = [ ( 'karthiga', 'One Piece', 9 ),
 for user, title, actual in tests:
 
     print( '\nActual score: %d' % actual )
+    P, expected, predicted = engine.scoreDistribution( user, title )
     for i in range( 1, 11 ):
 
-        print( 'P(R=%d) = %.5f%%' % ( i, np.exp( engine.scoreProb( user, i, title ) ) * 100 ) )
+        print( 'P(R=%d) = %.5f%%' % ( i, np.exp( P[i - 1] ) * 100 ) )
+
+    print( 'Expected score: %.2f, most likely score: %d' % ( expected, predicted ) )
 
 # In[143]:
 
@@ -0,0 +1,209 @@
+# Batch prediction from a model saved with engine.saveModel.
+#
+# Reads queries from a CSV file (with a header, and columns user, title and optionally score) or a JSON lines file
+# (one object per line with the same keys), and writes one prediction per query, in the same order and format: the
+# expected and the most likely score, the probability of each score (p1 to p10) and, for queries with a score, the
+# probability of that score. Queries for an unknown user or title, and malformed ones (a missing user or title, a score
+# that is not an integer, or a JSON line that is not an object), get an error column instead.
+#
+# The queries are read, scored and written a chunk at a time, so memory use does not depend on the size of the input.
+# Within a chunk, the queries of each user are scored together (see engine.scoreBatch). With --processes, chunks are
+# scored in parallel by worker processes that memory-map the same model.
+#
+# Example:
+#   python batch_predict.py model queries.csv --output predictions.csv --processes 4
+import argparse
+import csv
+import itertools
+import json
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import engine
+
+scoreColumnNames = [ 'p%d' % s for s in range( engine.minScore, engine.maxScore + 1 ) ]
+
+# Reads queries one at a time, as dicts with 'user', 'title' and, optionally, 'score'. A JSON line that is not an
+# object is read as None, so that it is reported as a malformed query rather than stopping the stream.
+#
+# Parameters:
+# - f: The open input file.
+# - fmt: 'csv' or 'jsonl'.
+def readQueries( f, fmt ):
+
+    if fmt == 'csv':
+        return csv.DictReader( f )
+    return ( parseJsonLine( line ) for line in f if line.strip() )
+
+def parseJsonLine( line ):
+
+    try:
+        query = json.loads( line )
+    except ValueError:
+        return None
+    return query if isinstance( query, dict ) else None
+
+# Checks a query and extracts its fields.
+#
+# Return:
+# - The user and the title [string], and the score [int], or None if the query has none.
+# Raises ValueError, with the message to report, if the query is malformed.
+def parseQuery( query ):
+
+    if not isinstance( query, dict ):
+        raise ValueError( 'malformed query' )
+    for field in ( 'user', 'title' ):
+
+        if query.get( field ) in ( None, '' ):
+            raise ValueError( 'missing %s' % field )
+
+    score = query.get( 'score' )
+    if score in ( None, '' ):
+        score = None
+    elif isinstance( score, bool ) or ( isinstance( score, float ) and not score.is_integer() ):
+        raise ValueError( 'invalid score' )
+    else:
+        try:
+            score = int( score )
+        except ( TypeError, ValueError ):
+            raise ValueError( 'invalid score' )
+
+    return str( query['user'] ), str( query['title'] ), score
+
+# Scores a chunk of queries. Malformed queries get an error instead of a prediction.
+#
+# Parameters:
+# - queries: The queries [list of dict].
+#
+# Return:
+# - The predictions, in the same order [list of dict].
+def scoreChunk( queries ):
+
+    # Group queries by user, keeping their positions
+    results = [None] * len( queries )
+    byUser = {}
+    for i, query in enumerate( queries ):
+
+        try:
+            user, title, score = parseQuery( query )
+        except ValueError as e:
+            fields = query if isinstance( query, dict ) else {}
+            results[i] = { 'user': fields.get( 'user' ), 'title': fields.get( 'title' ), 'error': str( e ) }
+            continue
+        byUser.setdefault( user, [] ).append( ( i, title, score ) )
+
+    scores = np.arange( engine.minScore, engine.maxScore + 1 )
+    for user, queued in byUser.items():
+
+        P = engine.scoreBatch( user, [title for i, title, score in queued] )
+        for row, ( i, title, score ) in enumerate( queued ):
+
+            result = { 'user': user, 'title': title }
+            if P is None or np.isnan( P[row,0] ):
+                result['error'] = 'unknown user' if P is None else 'unknown title'
+            else:
+                result['expected'] = float( P[row].dot( scores ) )
+                result['mostLikely'] = int( scores[np.argmax( P[row] )] )
+                result.update( zip( scoreColumnNames, P[row].tolist() ) )
+                if score is not None:
+                    result['score'] = score
+                    result['probability'] = float( P[row,score - engine.minScore] ) if engine.minScore <= score <= engine.maxScore else 0.0
+            results[i] = result
+
+    return results
+
+# Writes predictions in the given format. CSV output always has every column, so that its header is fixed.
+class predictionWriter:
+
+    def __init__( self, f, fmt ):
+
+        self.f = f
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.writer = csv.DictWriter( f, [ 'user', 'title', 'expected', 'mostLikely' ] + scoreColumnNames + [ 'score', 'probability', 'error' ] )
+            self.writer.writeheader()
+
+    def write( self, results ):
+
+        if self.fmt == 'csv':
+            self.writer.writerows( results )
+        else:
+            self.f.writelines( json.dumps( result ) + '\n' for result in results )
+        self.f.flush()
+
+# Loads the model in a worker process.
+def initWorker( modelPath ):
+
+    engine.loadModel( modelPath )
+
+# Scores every query of the input and writes the predictions.
+#
+# Parameters:
+# - modelPath: The model directory, see engine.loadModel.
+# - inFile, outFile: The open input and output files.
+# - fmt: 'csv' or 'jsonl'.
+# - chunkSize: The number of queries scored at once.
+# - processes: The number of worker processes. If 1, scores in this process.
+#
+# Return:
+# - The number of queries.
+def predict( modelPath, inFile, outFile, fmt, chunkSize=10000, processes=1 ):
+
+    queries = readQueries( inFile, fmt )
+    chunks = iter( lambda: list( itertools.islice( queries, chunkSize ) ), [] )
+    writer = predictionWriter( outFile, fmt )
+    count = 0
+
+    if processes == 1:
+        engine.loadModel( modelPath )
+        for chunk in chunks:
+
+            writer.write( scoreChunk( chunk ) )
+            count += len( chunk )
+        return count
+
+    # At most two chunks per worker are read ahead, so that memory stays bounded
+    with ProcessPoolExecutor( max_workers = processes, initializer = initWorker, initargs = ( modelPath, ) ) as pool:
+        pending = deque()
+        for chunk in chunks:
+
+            pending.append( pool.submit( scoreChunk, chunk ) )
+            count += len( chunk )
+            if len( pending ) >= 2 * processes:
+                writer.write( pending.popleft().result() )
+
+        while pending:
+
+            writer.write( pending.popleft().result() )
+
+    return count
+
+def main( argv=None ):
+
+    parser = argparse.ArgumentParser( description = 'Predicts scores for a file of (user, title) queries from a saved model.' )
+    parser.add_argument( 'model', help = 'model directory written by engine.saveModel' )
+    parser.add_argument( 'input', help = 'CSV or JSON lines file of queries, or - for the standard input' )
+    parser.add_argument( '--output', default = '-', help = 'file to write the predictions to, or - for the standard output' )
+    parser.add_argument( '--format', choices = [ 'csv', 'jsonl' ], help = 'input and output format. If not given, taken from the input file extension' )
+    parser.add_argument( '--chunk-size', type = int, default = 10000, help = 'number of queries scored at once' )
+    parser.add_argument( '--processes', type = int, default = 1, help = 'number of worker processes' )
+    args = parser.parse_args( argv )
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'jsonl' if args.input.endswith( ( '.jsonl', '.json' ) ) else 'csv'
+
+    inFile = sys.stdin if args.input == '-' else open( args.input, newline = '' )
+    outFile = sys.stdout if args.output == '-' else open( args.output, 'w', newline = '' )
+    try:
+        count = predict( args.model, inFile, outFile, fmt, args.chunk_size, args.processes )
+    finally:
+        if inFile is not sys.stdin:
+            inFile.close()
+        if outFile is not sys.stdout:
+            outFile.close()
+    print( 'Predicted %d queries' % count, file = sys.stderr )
+
+if __name__ == '__main__':
+    main()
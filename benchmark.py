@@ -0,0 +1,217 @@
+# Benchmarks of the probability engine on synthetic data.
+#
+# Generates a catalogue and a set of scores of a given size and shape, then times (and, unless disabled,
+# records the peak memory allocated by) initialize, single EM iterations, vProbY, single scoreProb calls
+# and batches of scores (a whole catalogue per user, with scoreBatch and with recommend). Every measurement is
+# written as a JSON object on its own line, along with the parameters of the run and the version of the code
+# (see codeVersion), so results can be collected and compared.
+#
+# Example:
+#   python benchmark.py --users 20000 --titles 2000 --density 0.02 --output bench_output.txt
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import engine
+import metrics
+from engine_helpers import *
+
+showTypes = [ 'TV', 'Movie', 'OVA', 'Special', 'ONA' ]
+sources = [ 'Manga', 'Original', 'Light novel', 'Game', 'Visual novel' ]
+ratings = [ 'G', 'PG', 'PG-13', 'R', 'R+' ]
+
+# Generates a synthetic catalogue and scores.
+#
+# Scores follow a simple latent-trait model: each user and each title gets a random bias, and a score is
+# 1 + Binomial(9, p) with p = sigmoid(skew + user bias + title bias). Titles are picked with Zipf-like
+# popularity, so that a few titles get most of the scores, as in real rating data.
+#
+# Parameters:
+# - users: The number of users.
+# - titles: The number of titles.
+# - tagsPerTitle: The number of tags of each title (at least 8: type, source, episode count, rating, one studio,
+#                 duration, start year and one or more genres).
+# - density: The expected fraction of the titles scored by each user.
+# - skew: Shifts the scores up (positive) or down (negative). 0 centers them on 5.5.
+# - seed: The random seed.
+#
+# Return:
+# - The catalogue, as given to engine.initialize [map of title to anime]
+# - The scores [engine.scoreColumns]
+def synthesize( users, titles, tagsPerTitle=8, density=0.02, skew=0.0, seed=0 ):
+
+    assert tagsPerTitle >= 8
+    rng = np.random.default_rng( seed )
+
+    animeList = {}
+    genres = [ 'genre%d' % g for g in range( max( 2 * ( tagsPerTitle - 7 ), 20 ) ) ]
+    studios = [ 'studio%d' % s for s in range( max( titles // 20, 1 ) ) ]
+    for i in range( titles ):
+
+        showType = showTypes[rng.integers( len( showTypes ) )]
+        animeList['title%d' % i] = engine.anime( showType, sources[rng.integers( len( sources ) )],
+                int( rng.integers( 1, 60 ) ) if showType == 'TV' else None, ratings[rng.integers( len( ratings ) )],
+                [studios[rng.integers( len( studios ) )]], list( rng.choice( genres, tagsPerTitle - 7, replace = False ) ),
+                int( rng.integers( 3, 120 ) ), int( rng.integers( 1970, 2020 ) ) )
+
+    # Number of scores of each user, then the titles they scored, by popularity
+    counts = np.maximum( rng.poisson( density * titles, users ), 1 )
+    userCodes = np.repeat( np.arange( users ), counts )
+    popularity = 1 / np.arange( 1, titles + 1 ) ** 0.8
+    titleCodes = rng.choice( titles, len( userCodes ), p = popularity / np.sum( popularity ) )
+
+    userBias = rng.normal( 0, 1, users )
+    titleBias = rng.normal( 0, 0.5, titles )
+    p = 1 / ( 1 + np.exp( -( skew + userBias[userCodes] + titleBias[titleCodes] ) ) )
+    scores = minScore + rng.binomial( maxScore - minScore, p )
+
+    return animeList, engine.scoreColumns( [ 'user%d' % t for t in range( users ) ], userCodes, list( animeList ), titleCodes, scores )
+
+# Runs a function, measuring its wall time and, if memory is True, the peak memory it allocated.
+#
+# Return:
+# - The result of the function
+# - The measurement [dict]
+def measure( function, memory ):
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, { 'seconds': seconds, 'peakBytes': peak }
+
+# The version of the code being benchmarked, as given by git describe (with -dirty if there are uncommitted changes),
+# or None if it is not in a git checkout.
+def codeVersion():
+
+    try:
+        return subprocess.run( [ 'git', 'describe', '--always', '--dirty' ], cwd = os.path.dirname( os.path.abspath( __file__ ) ),
+                               capture_output = True, text = True, check = True ).stdout.strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+# Runs every benchmark.
+#
+# Parameters:
+# - args: The parsed command line arguments.
+# - emit: Called with each measurement [dict].
+def runBenchmarks( args, emit ):
+
+    params = { 'users': args.users, 'titles': args.titles, 'tagsPerTitle': args.tags_per_title, 'density': args.density,
+               'skew': args.skew, 'seed': args.seed, 'compact': args.compact, 'shards': args.shards, 'version': codeVersion() }
+    memory = not args.no_memory
+
+    def record( name, measurement, **extra ):
+
+        emit( dict( { 'benchmark': name }, **measurement, **extra, params = params ) )
+
+    ( animeList, scores ), m = measure( lambda: synthesize( args.users, args.titles, args.tags_per_title, args.density, args.skew,
+                                                            args.seed ), memory )
+    record( 'synthesize', m, scores = len( scores ) )
+
+    with contextlib.redirect_stdout( io.StringIO() ):
+        _, m = measure( lambda: engine.initialize( animeList, scores, compact = args.compact, shards = args.shards ), memory )
+    record( 'initialize', m, animeIterations = engine.EM_anime['iterations'], tagIterations = engine.EM_tag['iterations'] )
+
+    # Single EM iterations over the anime ratings, from fresh parameters
+    ratings = engine.animeRatings
+    PY, PR = initialParams( ratings.shape[1], randomSeed )
+    PY, PR = narrowLogProbs( PY, engine.PR_anime.dtype ), narrowLogProbs( PR, engine.PR_anime.dtype )
+    pool = emShards( ratings, args.shards, dtype = engine.PR_anime.dtype ) if args.shards > 1 else None
+    try:
+        for i in range( args.em_iterations ):
+
+            ( PY, PR, likelihood ), m = measure( lambda: emStep( PY, PR, ratings ) if pool is None else pool.emStep( PY, PR ), memory )
+            record( 'emIteration', m, iteration = i, likelihood = float( likelihood ) )
+    finally:
+        if pool is not None:
+            pool.close()
+
+    _, m = measure( lambda: vProbY( engine.PY_anime, engine.PR_anime, ratings ), memory )
+    record( 'vProbY', m, users = len( ratings ) )
+
+    rng = np.random.default_rng( args.seed )
+    usernames = list( engine.users )
+    queryUsers = [usernames[t] for t in rng.integers( len( usernames ), size = args.queries )]
+    queryTitles = [engine.animeTitles[i] for i in rng.integers( len( engine.animeTitles ), size = args.queries )]
+    queryScores = rng.integers( minScore, maxScore + 1, size = args.queries )
+
+    def single():
+
+        for username, title, score in zip( queryUsers, queryTitles, queryScores ):
+
+            engine.scoreProb( username, int( score ), title )
+
+    _, m = measure( single, memory )
+    record( 'scoreProb', m, calls = args.queries, secondsPerCall = m['seconds'] / args.queries )
+
+    # Every score of every title for each user at once
+    batchUsers = queryUsers[:max( args.queries // 10, 1 )]
+
+    def batch():
+
+        for username in batchUsers:
+
+            engine.scoreBatch( username, engine.animeTitles )
+
+    _, m = measure( batch, memory )
+    record( 'scoreBatch', m, calls = len( batchUsers ), titlesPerCall = len( engine.animeTitles ),
+            secondsPerScore = m['seconds'] / ( len( batchUsers ) * len( engine.animeTitles ) ) )
+
+    # The same, ranked by recommend
+    def ranked():
+
+        for username in batchUsers:
+
+            engine.recommend( username, len( engine.animeTitles ), excludeRated = False )
+
+    _, m = measure( ranked, memory )
+    record( 'recommend', m, calls = len( batchUsers ), titlesPerCall = len( engine.animeTitles ),
+            secondsPerScore = m['seconds'] / ( len( batchUsers ) * len( engine.animeTitles ) ) )
+
+    # Peak resident memory of the whole process (kilobytes on Linux)
+    emit( { 'benchmark': 'process', 'maxRssKilobytes': metrics.maxRss(), 'params': params } )
+
+def main( argv=None ):
+
+    parser = argparse.ArgumentParser( description = 'Benchmarks the probability engine on synthetic data.' )
+    parser.add_argument( '--users', type = int, default = 5000 )
+    parser.add_argument( '--titles', type = int, default = 1000 )
+    parser.add_argument( '--tags-per-title', type = int, default = 10 )
+    parser.add_argument( '--density', type = float, default = 0.02, help = 'expected fraction of the titles scored by each user' )
+    parser.add_argument( '--skew', type = float, default = 0.5, help = 'shifts the scores up (positive) or down (negative)' )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    parser.add_argument( '--compact', action = 'store_true', help = 'use the compact int8/float32 mode' )
+    parser.add_argument( '--shards', type = int, default = 1, help = 'number of worker processes to split the users between in EM' )
+    parser.add_argument( '--em-iterations', type = int, default = 3 )
+    parser.add_argument( '--queries', type = int, default = 1000, help = 'number of single scoreProb calls' )
+    parser.add_argument( '--no-memory', action = 'store_true', help = 'do not trace memory, which slows down allocation-heavy code' )
+    parser.add_argument( '--output', help = 'file to append the JSON lines to, instead of the standard output' )
+    args = parser.parse_args( argv )
+
+    out = open( args.output, 'a' ) if args.output else sys.stdout
+    try:
+        def emit( measurement ):
+
+            out.write( json.dumps( measurement ) + '\n' )
+            out.flush()
+
+        runBenchmarks( args, emit )
+    finally:
+        if args.output:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# Regression check of the EM steps against a dense reference.
+#
+# The EM steps in engine_helpers work on sparse ratings, one block of users at a time, and calculate the weight of
+# the users that did not rate an item by subtraction (with an exact pass where that would lose precision). This
+# checks them against denseUpdate, a direct dense implementation of the same update over a users x items array,
+# on random ratings of several shapes:
+# - sparse: few ratings per user.
+# - dense: almost every user rated every item, which takes the exact pass of logUnratedWeight.
+# - fullColumn: one item rated by every user, with only 3 different scores, so that the PR of the others become -inf.
+# Each step starts from the reference's previous parameters, so differences do not compound, and PY, PR and the
+# likelihood must all be within errorTolerance of the reference. Prints one line per case and exits with 1 on any
+# mismatch.
+#
+# Example:
+#   python check_em.py --iterations 5 --shards 2
+import argparse
+import sys
+import numpy as np
+from engine_helpers import *
+
+# Runs an iteration of the EM algorithm over dense ratings, with no blocks or shortcuts.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# r - r[t][j] = r^t_j - The ratings of each user, -1 where unrated
+#
+# Returns:
+# - The updated PY
+# - The updated PR
+# - The log-likelihood of the given PY and PR
+def denseUpdate( PY, PR, r ):
+
+    T, n = r.shape
+    k, n, S = PR.shape
+
+    # log P(Y=y)PROD[P(R=r^t|Y=y)], skipping unrated items
+    ratings = np.equal( r[:,:,np.newaxis], np.arange( S )[np.newaxis,np.newaxis,:] )
+    with np.errstate( invalid = 'ignore' ):
+        picked = ratings[:,np.newaxis,:,:] * PR[np.newaxis,:,:,:]
+    picked[np.isnan( picked )] = 0 # 0 * -inf
+    qs = PY[np.newaxis,:] + np.sum( picked, axis = ( 2, 3 ) )
+    evidence = logsumexp( qs, axis = 1 )
+    pit = np.transpose( qs - evidence[:,np.newaxis] )
+    pi = logsumexp( pit, axis = 1 )
+
+    # Users that rated j count towards their score only; users that did not share the old PR[y][j]
+    scores = np.transpose( r )
+    unrated = np.equal( scores, -1 )
+    match = np.equal( scores[:,:,np.newaxis], np.arange( S )[np.newaxis,np.newaxis,:] )
+    notMatch = np.logical_not( np.logical_or( match, unrated[:,:,np.newaxis] ) )
+    notMatchFactor = np.zeros( ( n, T, S ) )
+    notMatchFactor[notMatch] = -np.inf
+    with np.errstate( invalid = 'ignore' ):
+        unratedFactor = PR[:,:,np.newaxis,:] * unrated[np.newaxis,:,:,np.newaxis]
+    unratedFactor[np.isnan( unratedFactor )] = 0
+    newPR = logsumexp( pit[:,np.newaxis,:,np.newaxis] + notMatchFactor[np.newaxis,:,:,:] + unratedFactor, axis = 2 )
+
+    return np.log( 1 / T ) + pi, newPR - pi[:,np.newaxis,np.newaxis], np.sum( evidence ) / T
+
+# The largest difference between two arrays of log-probabilities. Both must be -inf in the same places.
+def logDifference( a, b ):
+
+    if not np.array_equal( np.isneginf( a ), np.isneginf( b ) ):
+        return np.inf
+    finite = np.isfinite( a )
+    return float( np.max( np.abs( a[finite] - b[finite] ) ) ) if np.any( finite ) else 0.0
+
+# Draws random dense ratings.
+#
+# Parameters:
+# - users, items: The shape of the ratings.
+# - density: The probability that a user rated an item.
+# - fullColumns: The number of items rated by every user, with one of the 3 lowest scores.
+# - rng: The random generator.
+def randomRatings( users, items, density, fullColumns, rng ):
+
+    r = np.where( rng.random( ( users, items ) ) < density, rng.integers( 0, maxScore - minScore + 1, ( users, items ) ), -1 )
+    r[:,:fullColumns] = rng.integers( 0, 3, ( users, fullColumns ) )
+    return r
+
+# Checks emStep (and, with shards, emShards) against denseUpdate on a set of ratings.
+#
+# Return:
+# - The largest difference of PY, PR and the likelihood over every iteration and implementation
+def checkCase( r, iterations, blockSize, shards ):
+
+    sparseR = ratingMatrix.fromDense( r )
+    PY, PR = initialParams( r.shape[1], randomSeed )
+    pool = emShards( sparseR, shards, blockSize ) if shards > 1 else None
+    worst = 0.0
+    try:
+        for i in range( iterations ):
+
+            expected = denseUpdate( PY, PR, r )
+            results = [emStep( PY, PR, sparseR, blockSize )]
+            if pool is not None:
+                results.append( pool.emStep( PY, PR ) )
+
+            for newPY, newPR, likelihood in results:
+
+                worst = max( worst, logDifference( newPY, expected[0] ), logDifference( newPR, expected[1] ),
+                             abs( likelihood - expected[2] ) )
+
+            PY, PR = expected[0], expected[1]
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return worst
+
+def main( argv=None ):
+
+    parser = argparse.ArgumentParser( description = 'Checks the EM steps against a dense reference implementation.' )
+    parser.add_argument( '--users', type = int, default = 300 )
+    parser.add_argument( '--items', type = int, default = 40 )
+    parser.add_argument( '--iterations', type = int, default = 5 )
+    parser.add_argument( '--block-size', type = int, default = 64, help = 'users per block, small so that every case has several blocks' )
+    parser.add_argument( '--shards', type = int, default = 1, help = 'also check emShards with this many worker processes' )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    args = parser.parse_args( argv )
+
+    rng = np.random.default_rng( args.seed )
+    cases = { 'sparse': ( 0.1, 0 ), 'dense': ( 0.98, 0 ), 'fullColumn': ( 0.3, 1 ) }
+    failed = False
+    for name, ( density, fullColumns ) in cases.items():
+
+        r = randomRatings( args.users, args.items, density, fullColumns, rng )
+        worst = checkCase( r, args.iterations, args.block_size, args.shards )
+        ok = worst <= errorTolerance
+        failed = failed or not ok
+        print( '%-10s max difference %.3g %s' % ( name, worst, 'ok' if ok else 'MISMATCH' ) )
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
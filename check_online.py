@@ -0,0 +1,60 @@
+# Quality check of online EM against full-batch EM.
+#
+# Fits runEM to the first half of the users of a synthetic data set (see benchmark.synthesize), then streams the
+# other half through onlineEM in batches, as updateOnline does with new users. The mean log-likelihood of every
+# user under the streamed model is compared with that under a runEM fit to all of them at once:
+# - The relative gap, (full - online) / |full|, must be at most maxGap.
+# - The streamed model must do better than the half fit alone, or the updates are not learning anything.
+# Both fits have 15 types over titles x 10 scores, so with few users per title they overfit and the gap says
+# little; the defaults have enough users for the likelihoods to be comparable. Exits with 1 if either check fails.
+#
+# Example:
+#   python check_online.py --users 20000 --batch-size 500
+import argparse
+import sys
+import numpy as np
+import benchmark
+from engine_helpers import *
+
+maxGap = 0.03 # Largest accepted relative gap in mean log-likelihood between online and full-batch EM
+
+def main( argv=None ):
+
+    parser = argparse.ArgumentParser( description = 'Checks online EM against full-batch EM on synthetic data.' )
+    parser.add_argument( '--users', type = int, default = 20000 )
+    parser.add_argument( '--titles', type = int, default = 100 )
+    parser.add_argument( '--density', type = float, default = 0.1 )
+    parser.add_argument( '--batch-size', type = int, default = 500, help = 'users per online batch' )
+    parser.add_argument( '--max-gap', type = float, default = maxGap, help = 'largest accepted relative gap in mean log-likelihood' )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    args = parser.parse_args( argv )
+
+    animeList, scores = benchmark.synthesize( args.users, args.titles, density = args.density, seed = args.seed )
+    r = ratingMatrix.fromCoo( scores.userCodes, scores.titleCodes, scores.scores.astype( np.int64 ) - minScore,
+                              ( len( scores.userNames ), len( scores.titleNames ) ) )
+    T = r.shape[0]
+    half = T // 2
+
+    PY, PR, report = runEM( r, verbose = False )
+    full = logLikelihood( PY, PR, r )
+
+    PY, PR, report = runEM( r.rowSlice( 0, half ), verbose = False )
+    halfOnly = logLikelihood( PY, PR, r )
+    online = onlineEM( PY, PR, users = half )
+    for start in range( half, T, args.batch_size ):
+
+        online.update( r.rowSlice( start, min( start + args.batch_size, T ) ) )
+
+    streamed = logLikelihood( online.PY, online.PR, r )
+    gap = ( full - streamed ) / abs( full )
+    ok = gap <= args.max_gap and streamed > halfOnly
+
+    print( 'full-batch %.4f' % full )
+    print( 'half fit   %.4f' % halfOnly )
+    print( 'online     %.4f (%d batches)' % ( streamed, online.batches ) )
+    print( 'gap        %.2f%% (bound %.2f%%) %s' % ( 100 * gap, 100 * args.max_gap, 'ok' if ok else 'MISMATCH' ) )
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -1,6 +1,12 @@
+import contextlib
+import json
+import numbers
+import os
 from statistics import mean
 from engine_helpers import *
+import metrics
 import numpy as np
+from scipy import sparse
 from scipy.misc import logsumexp
 
 # Module that handles probability calculations
@@ -10,6 +16,8 @@ from scipy.misc import logsumexp
 # No fields may be None, except episodeN if type is not TV.
 class anime:
 
+    __slots__ = ( 'showType', 'source', 'episodeN', 'rating', 'studio', 'genre', 'duration', 'start_year' )
+
     def __init__( self ):
 
         self.showType = None # The type of show (TV, Movie, OVA, etc) [string]
@@ -42,12 +50,18 @@ class anime:
         self.duration = nDuration # The duration of each episode in minutes [int]
         self.start_year = nStart # The year when the show started airing [int]
 
-    def getTags( self ):
+    # Parameters:
+    # - bins: The interior bin edges of the numeric fields to tag by bin rather than by exact value [map of string to float array],
+    #         as in engine.tagBins. If None, every field is tagged by its exact value.
+    def getTags( self, bins=None ):
+
+        if bins is None:
+            bins = {}
 
         tags = []
         tags.append( 'type:' + self.showType )
         tags.append( 'source:' + self.source )
-        tags.append( 'episodeN:' + str( self.episodeN ) )
+        tags.append( 'episodeN:' + binLabel( self.episodeN, bins.get( 'episodeN' ) ) )
         tags.append( 'rating:' + str( self.rating ) )
         for s in self.studio:
             
@@ -57,8 +71,8 @@ class anime:
             
             tags.append( 'genre:' + str( g ) )
 
-        tags.append( 'duration:' + str( self.duration ) )
-        tags.append( 'start_year:' + str( self.start_year ) )
+        tags.append( 'duration:' + binLabel( self.duration, bins.get( 'duration' ) ) )
+        tags.append( 'start_year:' + binLabel( self.start_year, bins.get( 'start_year' ) ) )
 
         return tags
 
@@ -86,8 +100,68 @@ class anime:
         assert self.start_year is not None
         assert isinstance( self.start_year, int )
 
+# Labels a numeric field of an anime with its bin, as '[low,high)'.
+#
+# Parameters:
+# - value: The value of the field. None is labelled 'None'.
+# - edges: The interior bin edges, in increasing order [float array]. If None, the value is its own label.
+def binLabel( value, edges ):
+
+    if value is None or edges is None:
+        return str( value )
+
+    i = int( np.searchsorted( edges, value, side = 'right' ) )
+    low = '%.10g' % edges[i - 1] if i > 0 else '-inf'
+    high = '%.10g' % edges[i] if i < len( edges ) else 'inf'
+    return '[' + low + ',' + high + ')'
+
+# Calculates the interior bin edges of a numeric field of the animes.
+#
+# Parameters:
+# - values: The values of the field, without None [list of number].
+# - spec: The number of bins [int], with edges at the quantiles of the values (repeated edges are merged, so there
+#         may be fewer bins), or the interior edges themselves [list of number].
+#
+# Return:
+# - The interior bin edges, in increasing order [float array].
+def binEdges( values, spec ):
+
+    if isinstance( spec, numbers.Integral ):
+        assert spec >= 1
+        spec = int( spec )
+        if not values:
+            return np.zeros( 0 )
+        return np.unique( np.quantile( np.asarray( values, dtype = np.float64 ), np.linspace( 0, 1, spec + 1 )[1:-1] ) )
+
+    edges = np.asarray( spec, dtype = np.float64 )
+    assert edges.ndim == 1 and np.all( edges[1:] > edges[:-1] )
+    return edges
+
+# Scores given to animes by users, stored as columns of integer codes instead of a tuple per score.
+# Scores already encoded against the database can be given with titleNames = engine.animeTitles after initialize,
+# or list( animeList ) before, and the index of each show as its title code.
+class scoreColumns:
+
+    def __init__( self, userNames, userCodes, titleNames, titleCodes, scores ):
+
+        self.userNames = userNames # The username of each user code [sequence of string]
+        self.userCodes = np.asarray( userCodes ) # The user code of each score [int array]
+        self.titleNames = titleNames # The title of each title code [sequence of string]
+        self.titleCodes = np.asarray( titleCodes ) # The title code of each score [int array]
+        self.scores = np.asarray( scores ) # The score of each score, in the range [1,10] [int8 array]
+
+        assert self.userCodes.shape == self.titleCodes.shape == self.scores.shape
+        assert np.all( np.logical_and( self.scores >= minScore, self.scores <= maxScore ) )
+        self.scores = self.scores.astype( np.int8, copy = False )
+
+    def __len__( self ):
+
+        return len( self.scores )
+
 animes = None
 animeData = None
+animeTagIds = None # The indices of the tags of each anime, see prepareCatalogue [list of int32 array]
+animeTagIncidence = None # animeTagIncidence[i][j] = number of times anime i has tag j [sparse matrix]
 tags = None
 users = None
 
@@ -97,185 +171,775 @@ tagRatings = None
 PY_anime = None
 PR_anime = None
 PY_anime_user = None
+EM_anime = None # Report of the EM run that fitted PY_anime and PR_anime
 
 PY_tag = None
 PR_tag = None
 PY_tag_user = None
+EM_tag = None # Report of the EM run that fitted PY_tag and PR_tag
+
+# Derived from the above by prepareServing, for scoring the whole catalogue at once
+animeTitles = None # The titles, in index order [list of string]
+animeTagMatrix = None # animeTagMatrix[i][j] = fraction of the tags of anime i that are tag j [sparse matrix]
+PR_tag_linear = None # PR_tag_linear[y][j * S + s] = P(Rj=s|Y=y)
+
+marginalCache = None # Per-user tag marginals, see enableMarginalCache [lruCache]
+userGrowth = None # Buffers of PY_anime_user and PY_tag_user while users are added by addUser [list of growableArray]
+onlineAnime = None # Online EM state of the per-anime model, see updateOnline [onlineEM]
+onlineTag = None # Online EM state of the per-tag model, see updateOnline [onlineEM]
+
+binnedFields = ( 'episodeN', 'duration', 'start_year' ) # The numeric fields of the anime class that can be binned
+tagBins = {} # The interior bin edges of each binned field, see initialize [map of string to float array]
+
+modelFormatVersion = 2 # Version of the models written by saveModel
 
 # Initializes the predictive engine.
-# Must be called before calling any other function.
+# Must be called before calling any other function (unless the state is restored with loadModel).
+# Each step is timed as a phase (see metrics), and each EM iteration sent as an event, if metrics has sinks.
 #
 # Parameters:
 # - animeList: The animes in the database. Must be a map where the key is the title and the value is an instance of the anime class.
-# - scores: The scores given to each anime by each user. Must be a list of tuples (username [string], title [string], score [int]).
-#           Score must be in the range [1,10].
-def initialize( animeList, scores ):
+# - scores: The scores given to each anime by each user. Must be a list of tuples (username [string], title [string], score [int]),
+#           or the same scores as columns [scoreColumns]. Score must be in the range [1,10].
+# - bins: How to bin the numeric fields in binnedFields into tags [map of string to int or list of number], see binEdges:
+#         either a number of quantile bins, derived from the animes given, or fixed interior edges. Fields not in the map are
+#         tagged with their exact value. The edges are saved with the model, so new shows are tagged the same way.
+# - compact: Whether to store the ratings as int8 and fit and serve the probabilities as compactDtype (float32) instead of float64,
+#            about halving the memory of the model. See compactReport for the accuracy lost.
+# - shards: If more than 1, each EM fit splits the users between this many worker processes (see emShards).
+def initialize( animeList, scores, bins=None, compact=False, shards=None ):
+
+    global animes, animeData, animeTitles, tagBins, users, animeRatings, tags, tagRatings
+    global PY_anime, PR_anime, EM_anime, PY_anime_user, PY_tag, PR_tag, EM_tag, PY_tag_user
+
+    with metrics.phase( 'initialize.validate' ):
+
+        print( 'Validating data' )
+
+        # Validate all anime entries
+        for title, a in animeList.items():
+
+            assert title
+            assert a
+            try:
+                a.validate()
+            except AssertionError:
+                print( str( a ) )
+                raise
+
+        # Map to array indices
+        animeTitles = list( animeList )
+        animes = dict( zip( animeTitles, range( len( animeTitles ) ) ) )
+        animeData = list( animeList.values() )
+
+        tagBins = {}
+        for field, spec in ( bins or {} ).items():
+
+            assert field in binnedFields
+            tagBins[field] = binEdges( [getattr( a, field ) for a in animeData if getattr( a, field ) is not None], spec )
+
+    with metrics.phase( 'initialize.parseUsers' ):
+
+        print( 'Parsing user lists' )
+
+        if not isinstance( scores, scoreColumns ):
+            scores = tupleColumns( scores )
+        users, animeRatings = columnRatings( scores )
+        assert len( users ) > 0, 'There are no scores to fit the model to'
+        if compact:
+            animeRatings = animeRatings.compact()
+        dtype = compactDtype if compact else None
+    
+    with metrics.phase( 'initialize.animeEM' ):
 
-    print( 'Validating data' )
+        print( 'Calculating per-anime probabilities' )
 
-    # Validate all anime entries
-    for title, a in animeList.items():
+        # Calculate PY and PR for animes in the database
+        PY_anime, PR_anime, EM_anime = runEMRestarts( animeRatings, dtype = dtype, callback = metrics.emCallback( 'anime' ), shards = shards )
 
-        assert title
-        assert a
-        try:
-            a.validate()
-        except AssertionError:
-            print( str( a ) )
-            raise
+        # Precompute PY for each user
+        PY_anime_user = vProbY( PY_anime, PR_anime, animeRatings )
+
+        assert aTolerantEquals( logsumexp( PY_anime_user, axis = 1 ), 0.0, dtypeTolerance( PY_anime_user.dtype ) )
+
+    with metrics.phase( 'initialize.tagRatings' ):
+
+        print( 'Parsing tags' )
+
+        # Map tags to array indices, in order of first appearance
+        tags = {}
+        for a in animeData:
 
-    # Map to array indices
-    global animes
-    global animeData
-    animes = {}
-    animeData = []
-    i = 0
-    for anime, data in animeList.items():
+            for tag in a.getTags( tagBins ):
+
+                if tag not in tags:
+                    tags[tag] = len( tags )
+
+        prepareCatalogue()
+
+        # Calculate average tag scores for each user
+        tagRatings = tagAverages( animeRatings )
+        if compact:
+            tagRatings = tagRatings.compact()
+    
+    with metrics.phase( 'initialize.tagEM' ):
+
+        print( 'Calculating per-tag probabilities' )
+    
+        PY_tag, PR_tag, EM_tag = runEMRestarts( tagRatings, dtype = dtype, callback = metrics.emCallback( 'tag' ), shards = shards )
 
-        animes[anime] = i
-        animeData.append( data )
-        i += 1
+        # Precompute PY for each user
+        PY_tag_user = vProbY( PY_tag, PR_tag, tagRatings )
 
-    print( 'Parsing user lists' )
+        assert aTolerantEquals( logsumexp( PY_tag_user, axis = 1 ), 0.0, dtypeTolerance( PY_tag_user.dtype ) )
 
-    # Collapse score list into maps of users to scores
-    userAnimeLists = {}
-    while scores:
+    with metrics.phase( 'initialize.prepareServing' ):
 
-        username, title, score = scores.pop()
+        prepareServing()
+
+    print( 'Engine initialized' )
+
+    return
+
+# Converts a list of score tuples into score columns, so it can be built the same way as columns given directly.
+# If a user scored the same show more than once, the first score is kept.
+#
+# Parameters:
+# - scores: The scores, as given to initialize. The list is emptied.
+#
+# Return:
+# - The scores, with the shows coded by their index [scoreColumns]
+def tupleColumns( scores ):
+
+    # Reversed, so that the first score of a repeated pair is the last one, which is the one kept
+    userCodes = {}
+    rows = []
+    cols = []
+    values = []
+    for username, title, score in reversed( scores ):
 
         assert username
         assert title
+        rows.append( userCodes.setdefault( username, len( userCodes ) ) )
+        cols.append( animes[title] )
+        values.append( score )
+
+    del scores[:]
+
+    return scoreColumns( list( userCodes ), np.array( rows, dtype = np.int64 ), animeTitles, np.array( cols, dtype = np.int64 ),
+                         np.array( values, dtype = np.int64 ) )
+
+# Builds the user index map and the anime ratings from score columns, with vectorized operations.
+# Users without scores are left out. If a user scored the same show more than once, the last score is kept.
+#
+# Parameters:
+# - scores: The scores [scoreColumns]. Every title must be in the database.
+#
+# Return:
+# - The index of each user [dict]
+# - The anime ratings [ratingMatrix]
+def columnRatings( scores ):
+
+    if len( scores ):
+        assert 0 <= scores.userCodes.min() and scores.userCodes.max() < len( scores.userNames )
+        assert 0 <= scores.titleCodes.min() and scores.titleCodes.max() < len( scores.titleNames )
+
+    # Shows already coded by their index need no mapping
+    if scores.titleNames is animeTitles:
+        titleIndex = np.arange( len( animeTitles ), dtype = np.int64 )
+    else:
+        titleIndex = np.array( [animes[title] for title in scores.titleNames], dtype = np.int64 )
+    present = np.flatnonzero( np.bincount( scores.userCodes, minlength = len( scores.userNames ) ) )
+    userIndex = np.full( len( scores.userNames ), -1, dtype = np.int64 )
+    userIndex[present] = np.arange( len( present ) )
+
+    users = { scores.userNames[c]: i for i, c in enumerate( present.tolist() ) }
+    assert len( users ) == len( present )
+    assert all( users )
+
+    animeRatings = ratingMatrix.fromCoo( userIndex[scores.userCodes], titleIndex[scores.titleCodes],
+                                         scores.scores.astype( np.int64 ) - minScore, ( len( users ), len( animes ) ) )
+    return users, animeRatings
+
+# Calculates the probability of the given user give the given score to the given show.
+#
+# Parameters:
+# - username: The username of the user to determine. Must be an existing username.
+# - score: The score to calculate the probability of. Must be in the range [1,10].
+# - title: The title of the show.
+# - info: The information of the show, as an instance of the anime class. If None, the engine will use the information given during
+#         initialization with a matching title.
+#
+# Return:
+# - The probability [float]. If the username did not match a known user, the score was outside the valid range, or info was None and the title
+#   did not match any know show, returns None.
+@metrics.timed( 'scoreProb' )
+def scoreProb( username, score, title, info=None ):
+
+    if not ( minScore <= score <= maxScore ):
+        return None
+
+    distribution = scoreDistribution( username, title, info )
+    if distribution is None:
+        return None
+
+    return distribution[0][score - minScore]
+
+# Builds the structures used to score the whole catalogue at once from the engine state.
+# Called by initialize and loadModel.
+def prepareServing():
+
+    global animeTitles, animeTagMatrix, PR_tag_linear, userGrowth, onlineAnime, onlineTag
+
+    userGrowth = None
+    onlineAnime = None
+    onlineTag = None
+    if marginalCache is not None:
+        marginalCache.clear()
+
+    animeTitles = list( animes )
+
+    # Repeated tags are summed, matching the average taken by scoreDistribution
+    tagCounts = np.asarray( animeTagIncidence.sum( axis = 1 ) ).ravel()
+    animeTagMatrix = sparse.diags( 1 / np.maximum( tagCounts, 1 ) ).dot( animeTagIncidence ).tocsr()
+
+    k, n, S = PR_tag.shape
+    PR_tag_linear = np.exp( PR_tag ).reshape( ( k, n * S ) )
+
+# Adds a user to the engine without retraining, so that their scores can be predicted.
+#
+# The user's probability of being of each type is calculated from their ratings against the
+# trained (and unchanged) PY and PR, of both the per-anime and the per-tag model. Tag ratings are
+# averaged the same way as in initialize. Takes time proportional to the number of ratings.
+#
+# Parameters:
+# - username: The username of the new user. Must not be an existing username.
+# - ratings: The scores given by the user. Must be a map where the key is the title of a show in the database
+#            and the value is the score, or a list of tuples (title [string], score [int]). Scores must be in the range [1,10].
+#
+# Return:
+# - The index of the new user [int].
+def addUser( username, ratings ):
+
+    global PY_anime_user, PY_tag_user
+
+    assert username
+    assert username not in users
+    if isinstance( ratings, dict ):
+        ratings = ratings.items()
+
+    userAnimeList = {}
+    for title, score in ratings:
+
+        assert title in animes
         assert minScore <= score <= maxScore
+        userAnimeList[animes[title]] = score
 
-        if username not in userAnimeLists:
-            userAnimeLists[username] = {}
+    animeIndices, animeScores, tagIndices, tagScores = userRatingArrays( userAnimeList )
 
-        userAnimeLists[username][title] = score
+    growth = userRowBuffers()
+    PY_anime_user = growth[0].append( probYForRatings( PY_anime, PR_anime, animeIndices, animeScores ) )
+    PY_tag_user = growth[1].append( probYForRatings( PY_tag, PR_tag, tagIndices, tagScores ) )
 
-    # Map users to array indices
-    global users
-    users = {}
-    i = 0
-    for username in userAnimeLists:
+    animeRatings.appendRow( animeIndices, animeScores )
+    tagRatings.appendRow( tagIndices, tagScores )
 
-      users[username] = i
-      i += 1
+    if isinstance( users, stringIndex ):
+        t = users.add( username )
+    else:
+        t = len( users )
+        users[username] = t
 
-    # Convert anime ratings to array
-    global animeRatings
-    animeRatings = np.full( ( len( users ), len( animes ) ), -1 )
-    for user in users:
+    assert t == len( PY_tag_user ) - 1
+    return t
 
-        for anime in userAnimeLists[user]:
+# Converts a user's scores into their rating arrays for both models.
+# Tag ratings are averaged the same way as in initialize.
+#
+# Parameters:
+# - userAnimeList: The scores given by the user. Must be a map where the key is the index of the show and the value is the score.
+#
+# Return:
+# - The indices of the shows rated, and the scores given to them [int arrays]
+# - The indices of the tags rated, and the (average) scores given to them [int arrays]
+# All scores are shifted to the range [0,S).
+def userRatingArrays( userAnimeList ):
 
-            animeRatings[users[user]][animes[anime]] = userAnimeLists[user][anime] - minScore
-    
-    print( 'Calculating per-anime probabilities' )
+    animeIndices = np.array( list( userAnimeList.keys() ), dtype = np.int64 )
+    animeScores = np.array( list( userAnimeList.values() ), dtype = np.int64 ) - minScore
+    userTagRatings = tagAverages( ratingMatrix.fromCoo( np.zeros( len( animeIndices ), dtype = np.int64 ), animeIndices, animeScores,
+                                                        ( 1, len( animeData ) ) ) )
+    tagIndices, tagScores = userTagRatings.row( 0 )
+    return animeIndices, animeScores, tagIndices, tagScores
 
-    # Calculate PY and PR for animes in the database
-    global PY_anime
-    global PR_anime
-    PY_anime, PR_anime = runEM( animeRatings )
+# Converts the tags of every show to tag indices, once, so that nothing after this touches tag strings.
+# Called by initialize and loadModel, once the tag index map is known.
+def prepareCatalogue():
 
-    # Precompute PY for each user
-    global PY_anime_user
-    PY_anime_user = vProbY( PY_anime, PR_anime, animeRatings )
+    global animeTagIds, animeTagIncidence
 
-    assert aTolerantEquals( logsumexp( PY_anime_user, axis = 1 ), 0.0 )
+    animeTagIds = [np.array( [tags[tag] for tag in a.getTags( tagBins )], dtype = np.int32 ) for a in animeData]
 
-    print( 'Parsing tags' )
+    # Repeated tags are summed
+    rows = np.repeat( np.arange( len( animeTagIds ) ), [len( js ) for js in animeTagIds] )
+    cols = np.concatenate( animeTagIds + [np.zeros( 0, dtype = np.int32 )] )
+    animeTagIncidence = sparse.csr_matrix( ( np.ones( len( rows ) ), ( rows, cols ) ), shape = ( len( animeData ), len( tags ) ) )
 
-    # Obtain tag set
-    tagSet = set()
-    for title, a in animeList.items():
+# Averages the scores each user gave to the shows with each tag, as sparse matrix products with animeTagIncidence.
+# A show with a repeated tag counts once for every repetition. Averages are rounded half to even, like round().
+#
+# Parameters:
+# - ratings: The anime ratings of the users [ratingMatrix]
+#
+# Return:
+# - The tag ratings of the same users [ratingMatrix]
+def tagAverages( ratings ):
 
-        for tag in a.getTags():
+    T, n = ratings.shape
+    rated = sparse.csr_matrix( ( np.ones( ratings.nnz ), ratings.indices, ratings.indptr ), shape = ( T, n ) )
+    scored = sparse.csr_matrix( ( ratings.scores + minScore, ratings.indices, ratings.indptr ), shape = ( T, n ), dtype = np.float64 )
 
-            tagSet.add( tag )
+    # All scores are positive, so both products have the same sparsity pattern
+    counts = rated.dot( animeTagIncidence ).tocsr()
+    sums = scored.dot( animeTagIncidence ).tocsr()
+    counts.sort_indices()
+    sums.sort_indices()
+    assert np.array_equal( counts.indptr, sums.indptr ) and np.array_equal( counts.indices, sums.indices )
 
-    # Map tags to array indices
-    global tags
-    tags = {}
-    i = 0
-    for tag in tagSet:
+    averages = np.rint( sums.data / counts.data ).astype( np.int64 ) - minScore
+    return ratingMatrix( counts.indptr, counts.indices, averages, ( T, animeTagIncidence.shape[1] ) )
 
-        tags[tag] = i
-        i += 1
+# The buffers behind PY_anime_user and PY_tag_user, created on first use.
+def userRowBuffers():
 
-    # Calculate average tag scores for each user
-    global tagRatings
-    tagRatings = np.full( ( len( users ), len( tags ) ), -1 )
-    for user in userAnimeLists:
+    global userGrowth
 
-        tagScore = {}
-        tagCount = {}
+    if userGrowth is None:
+        userGrowth = [growableArray( PY_anime_user ), growableArray( PY_tag_user )]
+    return userGrowth
 
-        for title, score in userAnimeLists[user].items():
+# Updates the trained model with a batch of new or changed scores, using online EM (see onlineEM)
+# on both the per-anime and the per-tag model, without retraining over every user.
+#
+# The users in the batch get their scores merged into their existing ones (new users are added),
+# and their probability of being of each type recalculated. The types of the other users are
+# not recalculated until the next call that includes them.
+#
+# Parameters:
+# - scores: The new or changed scores. Must be a list of tuples (username [string], title [string], score [int]),
+#           where the title is of a show in the database. Score must be in the range [1,10].
+#
+# Return:
+# - The log-likelihood of the batch users' ratings under each model before the update, as a tuple (anime, tag).
+#   An empty batch changes nothing, and returns (0.0, 0.0).
+def updateOnline( scores ):
 
-            if score is not None:
-                for tag in animeList[title].getTags():
+    global PY_anime, PR_anime, PY_tag, PR_tag, PY_anime_user, PY_tag_user
+    global onlineAnime, onlineTag, PR_tag_linear
 
-                    if tag not in tagScore:
-                        tagScore[tag] = 0
-                        tagCount[tag] = 0
-                    tagScore[tag] += score
-                    tagCount[tag] += 1
+    # Merge the batch into each user's full list of scores
+    changes = {}
+    for username, title, score in scores:
 
-        for tag in tagScore:
-            
-            tagRatings[users[user]][tags[tag]] = int( round( tagScore[tag]/tagCount[tag] ) )
-    
-    print( 'Calculating per-tag probabilities' )
-    
-    global PY_tag
-    global PR_tag
-    PY_tag, PR_tag = runEM( tagRatings )
+        assert username
+        assert title in animes
+        assert minScore <= score <= maxScore
+        changes.setdefault( username, {} )[animes[title]] = score
 
-    # Precompute PY for each user
-    global PY_tag_user
-    PY_tag_user = vProbY( PY_tag, PR_tag, tagRatings )
+    if not changes:
+        return 0.0, 0.0
 
-    assert aTolerantEquals( logsumexp( PY_tag_user, axis = 1 ), 0.0 )
+    batchUsers = list( changes )
+    batch = []
+    for username in batchUsers:
 
-    print( 'Engine initialized' )
+        userAnimeList = {}
+        if username in users:
+            indices, values = animeRatings.row( users[username] )
+            userAnimeList = dict( zip( indices.tolist(), ( values + minScore ).tolist() ) )
+        userAnimeList.update( changes[username] )
+        batch.append( userRatingArrays( userAnimeList ) )
 
-    return
+    # Online EM step on each model
+    if onlineAnime is None:
+        onlineAnime = onlineEM( PY_anime, PR_anime, users = len( animeRatings ) )
+        onlineTag = onlineEM( PY_tag, PR_tag, users = len( tagRatings ) )
 
-# Calculates the probability of the given user give the given score to the given show.
+    likelihoods = []
+    for model, ( iIndices, iScores ), ratings in ( ( onlineAnime, ( 0, 1 ), animeRatings ), ( onlineTag, ( 2, 3 ), tagRatings ) ):
+
+        rows = np.repeat( np.arange( len( batch ) ), [len( b[iIndices] ) for b in batch] )
+        batchRatings = ratingMatrix.fromCoo( rows, np.concatenate( [b[iIndices] for b in batch] ),
+                np.concatenate( [b[iScores] for b in batch] ), ( len( batch ), ratings.shape[1] ) )
+        likelihoods.append( model.update( batchRatings )[2] )
+
+    PY_anime, PR_anime = onlineAnime.PY, onlineAnime.PR
+    PY_tag, PR_tag = onlineTag.PY, onlineTag.PR
+    k, n, S = PR_tag.shape
+    PR_tag_linear = np.exp( PR_tag ).reshape( ( k, n * S ) )
+    if marginalCache is not None:
+        marginalCache.clear()
+
+    # Recalculate the types of the batch users
+    growth = userRowBuffers()
+    known = [( users[username], b ) for username, b in zip( batchUsers, batch ) if username in users]
+    for t, ( animeIndices, animeScores, tagIndices, tagScores ) in known:
+
+        growth[0].set( t, probYForRatings( PY_anime, PR_anime, animeIndices, animeScores ) )
+        growth[1].set( t, probYForRatings( PY_tag, PR_tag, tagIndices, tagScores ) )
+
+    PY_anime_user, PY_tag_user = growth[0].view(), growth[1].view()
+    animeRatings.setRows( [t for t, b in known], [b[0] for t, b in known], [b[1] for t, b in known] )
+    tagRatings.setRows( [t for t, b in known], [b[2] for t, b in known], [b[3] for t, b in known] )
+
+    for username, b in zip( batchUsers, batch ):
+
+        if username not in users:
+            addUser( username, [( animeTitles[i], s + minScore ) for i, s in zip( b[0], b[1] )] )
+
+    return tuple( likelihoods )
+
+# Ranks every show in the database by how the given user is predicted to score it.
 #
 # Parameters:
-# - username: The username of the user to determine. Must be an existing username.
-# - score: The score to calculate the probability of. Must be in the range [1,10].
-# - title: The title of the show.
-# - info: The information of the show, as an instance of the anime class. If None, the engine will use the information given during
-#         initialization with a matching title.
+# - username: The username of the user to recommend to.
+# - n: The number of shows to return.
+# - excludeRated: Whether to leave out the shows the user has already rated.
+# - atLeast: If None, ranks by expected score. Otherwise ranks by the probability of a score of at least this value.
 #
 # Return:
-# - The probability [float]. If the username did not match a known user, the score was outside the valid range, or info was None and the title
-#   did not match any know show, returns None.
-def scoreProb( username, score, title, info=None ):
+# - The top n shows, best first, as a list of tuples (title [string], expected score or probability [float]).
+#   If the username did not match a known user, returns None.
+@metrics.timed( 'recommend' )
+def recommend( username, n, excludeRated=True, atLeast=None ):
 
-    if username not in users:
+    t = users.get( username )
+    if t is None:
         return None
 
-    if not ( minScore <= score <= maxScore ):
+    S = maxScore - minScore + 1
+
+    # P(R_j=s) for every tag, then averaged over the tags of every show
+    tagProbs = np.exp( PY_tag_user[t] ).dot( PR_tag_linear ).reshape( ( -1, S ) )
+    probs = animeTagMatrix.dot( tagProbs )
+
+    if atLeast is None:
+        value = probs.dot( np.arange( minScore, maxScore + 1 ) )
+    else:
+        value = np.sum( probs[:,max( atLeast - minScore, 0 ):], axis = 1 )
+
+    if excludeRated:
+        value[animeRatings.row( t )[0]] = -np.inf
+
+    n = min( n, len( value ) )
+    top = np.argpartition( -value, n - 1 )[:n] if n > 0 else np.zeros( 0, dtype = int )
+    top = top[np.argsort( -value[top], kind = 'stable' )]
+    return [( animeTitles[i], float( value[i] ) ) for i in top if value[i] != -np.inf]
+
+# Calculates the probability of the given user giving each possible score to each of the given shows, all at once.
+# Gives the same probabilities as scoreDistribution for each show, but the user's tag marginals are only computed once.
+#
+# Parameters:
+# - username: The username of the user.
+# - titles: The titles of the shows [list of string].
+#
+# Return:
+# - P[i][s] = probability of score minScore + s for show i [float array]. Rows of titles not in the database are NaN.
+#   If the username did not match a known user, returns None.
+@metrics.timed( 'scoreBatch' )
+def scoreBatch( username, titles ):
+
+    t = users.get( username )
+    if t is None:
+        return None
+
+    S = maxScore - minScore + 1
+    indices = findKeys( animes, titles )
+    known = indices >= 0
+
+    tagProbs = np.exp( PY_tag_user[t] ).dot( PR_tag_linear ).reshape( ( -1, S ) )
+    P = np.full( ( len( titles ), S ), np.nan )
+    P[known] = animeTagMatrix[indices[known]].dot( tagProbs )
+    return P
+
+# Enables (or, with a size of 0, disables) caching each user's tag marginals for scoreDistribution
+# and scoreProb, keeping those of the maxSize most recently scored users. Repeat requests for a
+# cached user then only gather the rows of the show's tags. Each entry takes tags x S floats.
+#
+# Parameters:
+# - maxSize: The maximum number of users to keep.
+#
+# Return:
+# - The cache [lruCache], whose hits, misses and evictions counters can be read, or None if disabled.
+def enableMarginalCache( maxSize ):
+
+    global marginalCache
+    marginalCache = lruCache( maxSize ) if maxSize > 0 else None
+    return marginalCache
+
+# Calculates log P(R_j=s) for the given user, for every tag j and score s.
+#
+# Return:
+# - P[j][s] = log P(R_j=s) for user t
+def userTagMarginals( t ):
+
+    return logsumexp( PY_tag_user[t][:,np.newaxis,np.newaxis] + PR_tag, axis = 0 )
+
+# Calculates the probability of the given user giving each possible score to the given show.
+#
+# Parameters:
+# - username: The username of the user to determine. Must be an existing username.
+# - title: The title of the show.
+# - info: The information of the show, as an instance of the anime class. If None, the engine will use the information given during
+#         initialization with a matching title. Tags of the show that no show in the database has (such as a bin
+#         left empty by fixed bin edges) are ignored.
+#
+# Return:
+# - The log-probability of each score [float array]. Element i is the log-probability of score minScore + i.
+# - The expected score [float].
+# - The most likely score [int].
+# If the username did not match a known user, info was None and the title did not match any know show, or info had no known tags,
+# returns None.
+@metrics.timed( 'scoreDistribution' )
+def scoreDistribution( username, title, info=None ):
+
+    t = users.get( username )
+    if t is None:
         return None
 
     if info is None:
-        if title not in animes:
+        i = animes.get( title )
+        if i is None:
             return None
-        else:
-            info = animeData[animes[title]]
-   
-    s = score - minScore
-    t = users[username]
-    ps = []
-    for tag in info.getTags():
+        js = animeTagIds[i]
+    else:
+        js = findKeys( tags, info.getTags( tagBins ) )
+        js = js[js >= 0]
+        if len( js ) == 0:
+            return None
+
+    # P(R_j=s) for each tag j of the show, then averaged over the tags
+    if marginalCache is not None:
+        ps = marginalCache.get( t, userTagMarginals )[js,:]
+    else:
+        ps = logsumexp( PY_tag_user[t][:,np.newaxis,np.newaxis] + PR_tag[:,js,:], axis = 0 )
+    P = logsumexp( ps, axis = 0 ) - np.log( len( js ) )
+
+    scores = np.arange( minScore, maxScore + 1 )
+    return P, float( np.sum( np.exp( P ) * scores ) ), int( scores[np.argmax( P )] )
+
+# Builds an index map from keys listed in index order.
+def keyIndex( keys ):
+
+    return { str( key ): i for i, key in enumerate( keys ) }
+
+# Collects the state of the engine as a map of names to arrays.
+def modelArrays():
+
+    arrays = {
+        'PY_anime': PY_anime,
+        'PR_anime': PR_anime,
+        'PY_anime_user': PY_anime_user,
+        'PY_tag': PY_tag,
+        'PR_tag': PR_tag,
+        'PY_tag_user': PY_tag_user,
+    }
+
+    # Index maps as stringIndex arrays
+    for name, index in ( ( 'animes', animes ), ( 'users', users ), ( 'tags', tags ) ):
+
+        if not isinstance( index, stringIndex ):
+            index = stringIndex.fromDict( index )
+        elif index.added:
+            index = stringIndex.fromKeys( list( index ) )
+        arrays[name + '_blob'] = index.blob
+        arrays[name + '_offsets'] = index.offsets
+        arrays[name + '_order'] = index.order
+        arrays[name + '_position'] = index.position
+
+    for name, ratings in ( ( 'animeRatings', animeRatings ), ( 'tagRatings', tagRatings ) ):
+
+        arrays[name + '_indptr'] = ratings.indptr
+        arrays[name + '_indices'] = ratings.indices
+        arrays[name + '_scores'] = ratings.scores
+        arrays[name + '_shape'] = np.array( ratings.shape )
+
+    # Anime information, one entry per anime in index order. Studio and genre lists are flattened,
+    # with the end of each anime's list given by the cumulative counts.
+    arrays['anime_showType'] = np.array( [a.showType for a in animeData], dtype = str )
+    arrays['anime_source'] = np.array( [a.source for a in animeData], dtype = str )
+    arrays['anime_episodeN'] = np.array( [-1 if a.episodeN is None else a.episodeN for a in animeData], dtype = np.int64 )
+    arrays['anime_rating'] = np.array( [a.rating for a in animeData], dtype = str )
+    arrays['anime_duration'] = np.array( [a.duration for a in animeData], dtype = np.int64 )
+    arrays['anime_start_year'] = np.array( [a.start_year for a in animeData], dtype = np.int64 )
+    for field in ( 'studio', 'genre' ):
+
+        lists = [getattr( a, field ) for a in animeData]
+        arrays['anime_' + field] = np.array( [str( v ) for l in lists for v in l], dtype = str )
+        arrays['anime_' + field + '_end'] = np.cumsum( [len( l ) for l in lists], dtype = np.int64 )
+
+    for field, edges in tagBins.items():
+
+        arrays['bins_' + field] = edges
+
+    return arrays
+
+# Saves the state of the engine computed by initialize, so that it can be restored
+# with loadModel instead of retraining.
+#
+# The model is a directory holding one .npy file per array (the probability arrays, the ratings,
+# the anime information, the tag bin edges and the index maps as stringIndex arrays) and a manifest.json file with
+# the format version and the array names. Nothing is pickled, and every array can be memory-mapped.
+#
+# Parameters:
+# - path: The directory to write to. Created if it does not exist. May be the directory the current model was loaded from.
+def saveModel( path ):
+
+    arrays = modelArrays()
+    os.makedirs( path, exist_ok = True )
+
+    # The manifest of a model being written over goes first and the new one is written last, so that an interrupted
+    # save never looks like a complete model, even when it leaves a mix of old and new arrays
+    manifest = os.path.join( path, 'manifest.json' )
+    if os.path.exists( manifest ):
+        os.remove( manifest )
+    for name, array in arrays.items():
+
+        with replacedFile( os.path.join( path, name + '.npy' ) ) as f:
+            np.save( f, array, allow_pickle = False )
+
+    with replacedFile( manifest ) as f:
+        f.write( json.dumps( { 'version': modelFormatVersion, 'arrays': sorted( arrays ) } ).encode( 'utf-8' ) )
+
+# Opens a temporary file for writing (binary) that replaces the file at path when closed without error.
+# The old file is never truncated, so arrays still memory-mapped from it (say, by loadModel) keep their data.
+@contextlib.contextmanager
+def replacedFile( path ):
+
+    temp = '%s.%d.tmp' % ( path, os.getpid() )
+    try:
+        with open( temp, 'wb' ) as f:
+            yield f
+        os.replace( temp, path )
+    except BaseException:
+        if os.path.exists( temp ):
+            os.remove( temp )
+        raise
+
+# Reads the arrays of a model written by saveModel.
+#
+# Returns:
+# - The format version
+# - A map of names to arrays
+def readModelArrays( path, mmap ):
+
+    if os.path.isdir( path ):
+        if not os.path.exists( os.path.join( path, 'manifest.json' ) ):
+            raise ValueError( '%s is not a complete model: it has no manifest.json' % path )
+        with open( os.path.join( path, 'manifest.json' ) ) as f:
+            manifest = json.load( f )
+        mode = 'r' if mmap else None
+        return manifest['version'], { name: np.load( os.path.join( path, name + '.npy' ), mmap_mode = mode, allow_pickle = False )
+                for name in manifest['arrays'] }
+
+    # Version 1: single .npz archive
+    with np.load( path, allow_pickle = False ) as f:
+        arrays = { name: f[name] for name in f.files }
+    return int( arrays['version'] ), arrays
+
+# Checks that the restored arrays agree on the number of users, animes, tags and user types, so that a model
+# mixing arrays of different saves is rejected.
+#
+# Parameters:
+# - animeCount: The number of animes in the anime information.
+def checkModelShapes( animeCount ):
+
+    k = len( PY_anime )
+    expected = { 'users': ( len( users ), [PY_anime_user.shape[0], PY_tag_user.shape[0], animeRatings.shape[0], tagRatings.shape[0],
+                                            len( animeRatings.indptr ) - 1, len( tagRatings.indptr ) - 1] ),
+                 'animes': ( len( animes ), [animeCount, PR_anime.shape[1], animeRatings.shape[1]] ),
+                 'tags': ( len( tags ), [PR_tag.shape[1], tagRatings.shape[1]] ),
+                 'user types': ( k, [PR_anime.shape[0], PY_anime_user.shape[1], len( PY_tag ), PR_tag.shape[0], PY_tag_user.shape[1]] ),
+                 'anime ratings': ( int( animeRatings.indptr[-1] ), [len( animeRatings.indices ), len( animeRatings.scores )] ),
+                 'tag ratings': ( int( tagRatings.indptr[-1] ), [len( tagRatings.indices ), len( tagRatings.scores )] ) }
+    for name, ( count, sizes ) in expected.items():
+
+        if any( size != count for size in sizes ):
+            raise ValueError( 'Inconsistent model: %d %s, but arrays of sizes %s' % ( count, name, sizes ) )
+
+# Restores the state of the engine from a model written by saveModel.
+# After this call the engine can be used as if initialize had been called.
+#
+# With mmap (the default), the large arrays and the index maps are memory-mapped read-only
+# rather than read into memory, so every process that loads the same model shares a single
+# copy of them in the page cache. The engine must then not modify them.
+#
+# Parameters:
+# - path: The model directory (or, for version 1 models, the .npz file).
+# - mmap: Whether to memory-map the arrays.
+def loadModel( path, mmap = True ):
+
+    global animes, animeData, tags, users, tagBins
+    global animeRatings, tagRatings
+    global PY_anime, PR_anime, PY_anime_user, EM_anime
+    global PY_tag, PR_tag, PY_tag_user, EM_tag
+
+    version, f = readModelArrays( path, mmap )
+    if version not in ( 1, modelFormatVersion ):
+        raise ValueError( 'Unsupported model format version %d (expected %d)' % ( version, modelFormatVersion ) )
+
+    if version == 1:
+        animes, users, tags = [keyIndex( f[name] ) for name in ( 'animes', 'users', 'tags' )]
+    else:
+        animes, users, tags = [stringIndex( f[name + '_blob'], f[name + '_offsets'], f[name + '_order'], f[name + '_position'] )
+                for name in ( 'animes', 'users', 'tags' )]
+
+    PY_anime = f['PY_anime']
+    PR_anime = f['PR_anime']
+    PY_anime_user = f['PY_anime_user']
+    PY_tag = f['PY_tag']
+    PR_tag = f['PR_tag']
+    PY_tag_user = f['PY_tag_user']
+    EM_anime = None
+    EM_tag = None
+
+    animeRatings, tagRatings = [ratingMatrix( f[name + '_indptr'], f[name + '_indices'], f[name + '_scores'], f[name + '_shape'] )
+            for name in ( 'animeRatings', 'tagRatings' )]
+    checkModelShapes( len( f['anime_showType'] ) )
+
+    lists = {}
+    for field in ( 'studio', 'genre' ):
+
+        values = [str( v ) for v in f['anime_' + field]]
+        end = f['anime_' + field + '_end']
+        start = np.concatenate( ( [0], end[:-1] ) )
+        lists[field] = [values[s:e] for s, e in zip( start, end )]
+
+    columns = zip( f['anime_showType'], f['anime_source'], f['anime_episodeN'], f['anime_rating'], lists['studio'], lists['genre'],
+            f['anime_duration'], f['anime_start_year'] )
+    animeData = [anime( str( sType ), str( sSource ), None if nEpisode == -1 else int( nEpisode ), str( sRating ), lStudio, lGenre,
+            int( nDuration ), int( nStart ) ) for sType, sSource, nEpisode, sRating, lStudio, lGenre, nDuration, nStart in columns]
+
+    tagBins = { name[len( 'bins_' ):]: np.array( f[name] ) for name in f if name.startswith( 'bins_' ) }
+
+    prepareCatalogue()
+    prepareServing()
+
+    # Every array kept from the model must still be backed by its file: a private copy would be made in every process
+    if mmap and version != 1:
+        kept = { 'PY_anime': PY_anime, 'PR_anime': PR_anime, 'PY_anime_user': PY_anime_user,
+                 'PY_tag': PY_tag, 'PR_tag': PR_tag, 'PY_tag_user': PY_tag_user }
+        for name, index in ( ( 'animes', animes ), ( 'users', users ), ( 'tags', tags ) ):
+
+            for field in ( 'blob', 'offsets', 'order', 'position' ):
+
+                kept[name + '_' + field] = getattr( index, field )
 
-        j = tags[tag]
-        ps.append( logsumexp( PY_tag_user[t] + PR_tag[:,j,s] ) )
+        for name, ratings in ( ( 'animeRatings', animeRatings ), ( 'tagRatings', tagRatings ) ):
 
-    return logsumexp( np.array( ps ) ) - np.log( len( ps ) )
+            for field in ( 'indptr', 'indices', 'scores' ):
 
+                kept[name + '_' + field] = getattr( ratings, field )
 
+        copied = sorted( name for name, array in kept.items() if not isMemoryMapped( array ) )
+        assert not copied, 'Arrays copied out of the model files: %s' % ', '.join( copied )
@@ -1,7 +1,14 @@
 # Helper functions for the probability engine.
 import math
-import random
+import mmap
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
+from scipy import sparse
 from scipy.misc import logsumexp
 
 numUserTypes = 15
@@ -10,25 +17,536 @@ minScore = 1
 
 minInitialProbFrac = 0.1
 maxInitialProbFrac = 1.0 - minInitialProbFrac
-random.seed( a = 'OmaeWaMouShindeiru' )
+randomSeed = 'OmaeWaMouShindeiru' # Base seed of the initial EM parameters
+emRestarts = 1 # Number of independently initialized EM runs to pick the best from
+onlineStepDecay = 0.7 # Decay of the step size of onlineEM, in (0.5,1]
 
-runs = 128
+runs = 128 # Maximum number of EM iterations
+minLikelihoodGain = 0.000001 # EM stops when the log-likelihood improves by less than this...
+minRelativeLikelihoodGain = 0.0000001 # ...or by less than this fraction of its magnitude...
+convergencePatience = 1 # ...for this many consecutive iterations
+userBlockSize = 4096 # Number of users processed at once by the EM steps; bounds their memory use
 
 errorTolerance = 0.000000001
+compactDtype = np.float32 # Float type of the probability arrays in compact mode (see runEM)
+cancellationTolerance = 0.0001 # Fraction below which 1 - x is recomputed rather than subtracted
+
+# Array that can be grown along its first axis in amortized constant time per row,
+# by keeping spare capacity at its end.
+class growableArray:
+
+    def __init__( self, array ):
+
+        self.data = array # Buffer, of which the first size rows are in use [array]
+        self.size = len( array )
+
+    # Appends the given rows and returns the array of every row so far (a view into the buffer).
+    def append( self, rows ):
+
+        rows = np.asarray( rows, dtype = self.data.dtype ).reshape( ( -1, ) + self.data.shape[1:] )
+        size = self.size + len( rows )
+        if size > len( self.data ) or not self.data.flags.writeable:
+            data = np.empty( ( max( 2 * size, 16 ), ) + self.data.shape[1:], dtype = self.data.dtype )
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+        self.data[self.size:size] = rows
+        self.size = size
+        return self.data[:size]
+
+    # Overwrites row i.
+    def set( self, i, row ):
+
+        self.write( i, [row] )
+
+    # Overwrites the rows from start on with the given ones, and returns the array of every row.
+    def write( self, start, rows ):
+
+        rows = np.asarray( rows, dtype = self.data.dtype ).reshape( ( -1, ) + self.data.shape[1:] )
+        assert 0 <= start and start + len( rows ) <= self.size
+        if not self.data.flags.writeable:
+            self.data = np.array( self.data )
+        self.data[start:start + len( rows )] = rows
+        return self.view()
+
+    # Replaces the rows [start,size) with the given ones, and returns the array of every row.
+    def replaceTail( self, start, rows ):
+
+        assert 0 <= start <= self.size
+        rows = np.asarray( rows, dtype = self.data.dtype )
+        if np.may_share_memory( rows, self.data ):
+            rows = rows.copy() # They may be a view of the rows replaced
+        self.size = start
+        return self.append( rows )
+
+    # The array of every row so far (a view into the buffer).
+    def view( self ):
+
+        return self.data[:self.size]
+
+# Sparse (CSR) store of the ratings given by each user.
+#
+# Only the observed ratings are kept, so memory grows with the number of ratings
+# rather than with users x items. The ratings of user t are
+# scores[indptr[t]:indptr[t+1]], given to the items indices[indptr[t]:indptr[t+1]].
+# Scores are already shifted to the range [0,S) (i.e. score - minScore).
+class ratingMatrix:
+
+    def __init__( self, indptr, indices, scores, shape ):
+
+        self.indptr = np.asarray( indptr, dtype = np.int64 ) # Start of each user's ratings [int array, T+1]
+        self.indices = np.asarray( indices, dtype = np.int64 ) # Item of each rating [int array, nnz]
+        self.scores = scoreArray( scores ) # Value of each rating [int array, nnz], int8 in compact stores
+        self.shape = tuple( int( d ) for d in shape ) # ( T, n )
+        self._rows = None
+        self._columns = None
+        self._cellGroups = None
+        self._indicator = None
+        self._blocks = None
+        self._growth = None
+
+    # Builds the store from a list of ( user index, item index, score ) triplets given as
+    # three parallel arrays. If the same ( user, item ) pair appears more than once, the
+    # last rating wins.
+    @classmethod
+    def fromCoo( cls, rows, cols, scores, shape ):
+
+        rows = np.asarray( rows, dtype = np.int64 )
+        cols = np.asarray( cols, dtype = np.int64 )
+        scores = scoreArray( scores )
+        T, n = shape
+
+        # Sort by user then item, keeping the last occurrence of duplicated pairs
+        key = rows * n + cols
+        order = np.argsort( key, kind = 'stable' )
+        key = key[order]
+        last = np.append( key[1:] != key[:-1], True ) if len( key ) else np.zeros( 0, dtype = bool )
+        order = order[last]
+
+        rows = rows[order]
+        indptr = np.zeros( T + 1, dtype = np.int64 )
+        np.cumsum( np.bincount( rows, minlength = T ), out = indptr[1:] )
+        return cls( indptr, cols[order], scores[order], shape )
+
+    # Builds the store from a dense array where -1 marks an unrated item.
+    @classmethod
+    def fromDense( cls, r ):
+
+        r = np.asarray( r )
+        rows, cols = np.nonzero( np.not_equal( r, -1 ) )
+        return cls.fromCoo( rows, cols, r[rows, cols], r.shape )
+
+    # The user index of each stored rating [int array, nnz].
+    def rows( self ):
+
+        if self._rows is None:
+            self._rows = np.repeat( np.arange( self.shape[0] ), np.diff( self.indptr ) )
+        return self._rows
+
+    # The users that rated item j [int array].
+    def column( self, j ):
+
+        if self._columns is None:
+            order = np.argsort( self.indices, kind = 'stable' )
+            colptr = np.zeros( self.shape[1] + 1, dtype = np.int64 )
+            np.cumsum( np.bincount( self.indices, minlength = self.shape[1] ), out = colptr[1:] )
+            self._columns = ( self.rows()[order], colptr )
+        users, colptr = self._columns
+        return users[colptr[j]:colptr[j + 1]]
+
+    # Groups the stored ratings by ( item, score ) cell, for a score range of size S.
+    #
+    # Returns:
+    # - The order that sorts the ratings by cell [int array, nnz]
+    # - The position in that order where each non-empty cell starts [int array]
+    # - The flat index ( item * S + score ) of each non-empty cell [int array]
+    def cellGroups( self, S ):
+
+        if self._cellGroups is None or self._cellGroups[0] != S:
+            cell = self.indices * S + self.scores
+            order = np.argsort( cell, kind = 'stable' )
+            cell = cell[order]
+            starts = np.flatnonzero( np.append( True, cell[1:] != cell[:-1] ) ) if len( cell ) else np.zeros( 0, dtype = np.int64 )
+            self._cellGroups = ( S, order, starts, cell[starts] )
+        return self._cellGroups[1:]
+
+    # The one-hot indicator of the stored ratings, for a score range of size S.
+    #
+    # Returns:
+    # - X[t][j * S + s] = 1 if user t gave score s to item j, 0 otherwise [sparse matrix of dtype, T x ( n * S )]
+    def indicator( self, S, dtype = np.float64 ):
+
+        if self._indicator is None or self._indicator[0] != ( S, dtype ):
+            X = sparse.csr_matrix( ( np.ones( self.nnz, dtype = dtype ), self.indices * S + self.scores, self.indptr ),
+                    shape = ( self.shape[0], self.shape[1] * S ) )
+            self._indicator = ( ( S, dtype ), X )
+        return self._indicator[1]
+
+    # A copy of the store with its scores as int8, a quarter of the memory.
+    def compact( self ):
+
+        return ratingMatrix( self.indptr, self.indices, self.scores.astype( np.int8 ), self.shape )
+
+    # The ratings of users [start,stop) as a new ratingMatrix sharing this one's arrays.
+    def rowSlice( self, start, stop ):
+
+        a, b = self.indptr[start], self.indptr[stop]
+        return ratingMatrix( self.indptr[start:stop + 1] - a, self.indices[a:b], self.scores[a:b], ( stop - start, self.shape[1] ) )
+
+    # Splits the users into consecutive blocks of at most blockSize users.
+    # The blocks are cached, so that their own caches are kept across EM iterations.
+    def blocks( self, blockSize ):
+
+        if self._blocks is None or self._blocks[0] != blockSize:
+            if blockSize >= self.shape[0]:
+                blocks = [self]
+            else:
+                blocks = [self.rowSlice( start, min( start + blockSize, self.shape[0] ) ) for start in range( 0, self.shape[0], blockSize )]
+            self._blocks = ( blockSize, blocks )
+        return self._blocks[1]
+
+    # Adds a user with the given ratings, in amortized time proportional to their number.
+    #
+    # Returns:
+    # - The index of the new user
+    def appendRow( self, indices, scores ):
+
+        if self._growth is None:
+            self._growth = [growableArray( a ) for a in ( self.indptr, self.indices, self.scores )]
+        indptr, indicesBuffer, scoresBuffer = self._growth
+
+        self.indices = indicesBuffer.append( indices )
+        self.scores = scoresBuffer.append( scores )
+        self.indptr = indptr.append( [len( self.indices )] )
+        self.shape = ( self.shape[0] + 1, self.shape[1] )
+        self._rows = self._columns = self._cellGroups = self._indicator = self._blocks = None
+        return self.shape[0] - 1
+
+    # Replaces the ratings of the given users, in place. Rows that keep their number of ratings are
+    # overwritten where they are; the ratings after the first row that does not are moved once, with
+    # a single copy and no sorting.
+    #
+    # Parameters:
+    # users - The users to replace the ratings of, all different [list of int]
+    # indices - The items rated by each of those users [list of int arrays]
+    # scores - The scores given by each of those users [list of int arrays]
+    def setRows( self, users, indices, scores ):
+
+        if len( users ) == 0:
+            return
+        if self._growth is None:
+            self._growth = [growableArray( a ) for a in ( self.indptr, self.indices, self.scores )]
+        indptrBuffer, indicesBuffer, scoresBuffer = self._growth
+
+        # In user order, with the ratings of each user sorted by item, as fromCoo stores them
+        order = np.argsort( users, kind = 'stable' )
+        users = np.asarray( users, dtype = np.int64 )[order]
+        assert np.all( users[1:] != users[:-1] )
+        rows = []
+        for i in order:
+
+            itemOrder = np.argsort( indices[i], kind = 'stable' )
+            rows.append( ( np.asarray( indices[i], dtype = np.int64 )[itemOrder], np.asarray( scores[i] )[itemOrder] ) )
+
+        starts, ends = self.indptr[users], self.indptr[users + 1]
+        lengths = np.array( [len( i ) for i, s in rows], dtype = np.int64 )
+        resized = np.flatnonzero( lengths != ends - starts )
+        first = resized[0] if len( resized ) else len( users )
+
+        for r in range( first ):
+
+            self.indices = indicesBuffer.write( starts[r], rows[r][0] )
+            self.scores = scoresBuffer.write( starts[r], rows[r][1] )
+
+        if len( resized ):
+            # Everything from the first resized row on: the kept ratings between the replaced rows, and the new rows
+            keptEnds = np.append( starts[first + 1:], self.nnz )
+            newIndices = []
+            newScores = []
+            for r, keptEnd in zip( range( first, len( users ) ), keptEnds ):
+
+                newIndices += [rows[r][0], self.indices[ends[r]:keptEnd]]
+                newScores += [rows[r][1], self.scores[ends[r]:keptEnd]]
+
+            self.indices = indicesBuffer.replaceTail( starts[first], np.concatenate( newIndices ) )
+            self.scores = scoresBuffer.replaceTail( starts[first], np.concatenate( newScores ).astype( self.scores.dtype ) )
+
+            shift = np.zeros( self.shape[0] + 1, dtype = np.int64 )
+            shift[users + 1] = lengths - ( ends - starts )
+            self.indptr = indptrBuffer.write( 0, self.indptr + np.cumsum( shift ) )
+
+        self._rows = self._columns = self._cellGroups = self._indicator = self._blocks = None
+
+    # The items rated by user t and the scores given to them.
+    def row( self, t ):
+
+        start, end = self.indptr[t], self.indptr[t + 1]
+        return self.indices[start:end], self.scores[start:end]
+
+    @property
+    def nnz( self ):
+
+        return len( self.indices )
+
+    def __len__( self ):
+
+        return self.shape[0]
+
+# Converts scores to an array for ratingMatrix: int8 arrays are kept as they are, anything else becomes int64.
+def scoreArray( scores ):
+
+    scores = np.asarray( scores )
+    return scores if scores.dtype == np.int8 else scores.astype( np.int64, copy = False )
+
+# Read-only map of strings to array indices [0,n), stored in flat arrays so that it can be
+# memory-mapped from a model file and shared between processes.
+#
+# The keys are UTF-8 encoded and concatenated in sorted order into blob; the sorted key p is
+# blob[offsets[p]:offsets[p+1]] and maps to index order[p]. Index i has the sorted key position[i].
+# Lookups are a binary search over the sorted keys. Supports the read-only dict operations
+# used with index maps ( in, [], get, len, iteration and items ), iterating in index order.
+class stringIndex:
+
+    def __init__( self, blob, offsets, order, position ):
+
+        self.blob = blob # UTF-8 encoded keys, in sorted order [uint8 array]
+        self.offsets = offsets # Start of each sorted key in blob [int array, n+1]
+        self.order = order # Index mapped to by each sorted key [int array, n]
+        self.position = position # Sorted position of the key of each index [int array, n]
+        self.added = {} # Keys added after construction, mapped to indices n, n+1, ...
+        self.addedKeys = []
+        self._keyArray = None
+
+    # Builds the index of the given keys, mapping the i-th key to i.
+    @classmethod
+    def fromKeys( cls, keys ):
+
+        encoded = [key.encode( 'utf-8' ) for key in keys]
+        order = np.array( sorted( range( len( encoded ) ), key = encoded.__getitem__ ), dtype = np.int64 )
+        offsets = np.zeros( len( encoded ) + 1, dtype = np.int64 )
+        np.cumsum( [len( encoded[i] ) for i in order], out = offsets[1:] )
+        blob = np.frombuffer( b''.join( encoded[i] for i in order ), dtype = np.uint8 )
+        position = np.empty( len( order ), dtype = np.int64 )
+        position[order] = np.arange( len( order ) )
+        return cls( blob, offsets, order, position )
+
+    # Builds the index from a dict of keys to indices.
+    @classmethod
+    def fromDict( cls, index ):
+
+        keys = [None] * len( index )
+        for key, i in index.items():
+
+            keys[i] = key
+
+        return cls.fromKeys( keys )
+
+    def _sortedKey( self, p ):
+
+        return self.blob[self.offsets[p]:self.offsets[p + 1]].tobytes()
+
+    # Adds a key, mapping it to the next index. The arrays are left untouched,
+    # so this works on memory-mapped indices too.
+    #
+    # Returns:
+    # - The index of the key
+    def add( self, key ):
+
+        assert key not in self
+        self.added[key] = len( self )
+        self.addedKeys.append( key )
+        return self.added[key]
+
+    # The index of the given key, or -1 if it is not in the map.
+    def find( self, key ):
+
+        if not isinstance( key, str ):
+            return -1
+        if key in self.added:
+            return self.added[key]
+        key = key.encode( 'utf-8' )
+        lo, hi = 0, len( self.order )
+        while lo < hi:
+
+            mid = ( lo + hi ) // 2
+            if self._sortedKey( mid ) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len( self.order ) and self._sortedKey( lo ) == key:
+            return int( self.order[lo] )
+        return -1
+
+    # The index of each of the given keys, or -1 for those not in the map, with a single binary search over all of them.
+    #
+    # Parameters:
+    # keys - The keys [sequence or array of string]
+    #
+    # Returns:
+    # - The indices [int array]
+    def findMany( self, keys ):
+
+        keys = np.asarray( keys, dtype = str ).ravel()
+        found = np.full( len( keys ), -1, dtype = np.int64 )
+        if len( keys ) and len( self.order ):
+            sortedKeys = self.keyArray()
+            encoded = np.char.encode( keys, 'utf-8' )
+            fits = np.flatnonzero( np.char.str_len( encoded ) <= sortedKeys.itemsize ) # Longer keys are not in the map
+            queries = encoded[fits].astype( sortedKeys.dtype )
+            p = np.minimum( np.searchsorted( sortedKeys, queries ), len( sortedKeys ) - 1 )
+            match = sortedKeys[p] == queries
+            found[fits[match]] = self.order[p[match]]
+
+        if self.added:
+            for i in np.flatnonzero( found == -1 ):
+
+                found[i] = self.added.get( keys[i], -1 )
+
+        return found
+
+    # The sorted keys as a fixed-width bytes array, for findMany. Built once, without decoding the keys.
+    def keyArray( self ):
+
+        if self._keyArray is None:
+            lengths = np.diff( self.offsets )
+            width = max( int( np.max( lengths ) ), 1 ) if len( lengths ) else 1
+            padded = np.zeros( ( len( lengths ), width ), dtype = np.uint8 )
+            rows = np.repeat( np.arange( len( lengths ) ), lengths )
+            padded[rows, np.arange( len( rows ) ) - np.repeat( self.offsets[:-1] - self.offsets[0], lengths )] = self.blob[self.offsets[0]:self.offsets[-1]]
+            self._keyArray = padded.view( 'S%d' % width ).ravel()
+        return self._keyArray
+
+    # The key that maps to index i.
+    def key( self, i ):
+
+        if i >= len( self.order ):
+            return self.addedKeys[i - len( self.order )]
+        return self._sortedKey( self.position[i] ).decode( 'utf-8' )
+
+    def get( self, key, default = None ):
+
+        i = self.find( key )
+        return default if i == -1 else i
+
+    def items( self ):
+
+        return ( ( self.key( i ), i ) for i in range( len( self ) ) )
+
+    def __getitem__( self, key ):
+
+        i = self.find( key )
+        if i == -1:
+            raise KeyError( key )
+        return i
+
+    def __contains__( self, key ):
+
+        return self.find( key ) != -1
+
+    def __iter__( self ):
+
+        return ( self.key( i ) for i in range( len( self ) ) )
+
+    def __len__( self ):
+
+        return len( self.order ) + len( self.addedKeys )
+
+# The index of each of the given keys in an index map (a dict or a stringIndex), or -1 for those not in it.
+#
+# Returns:
+# - The indices [int array]
+def findKeys( index, keys ):
+
+    if isinstance( index, stringIndex ):
+        return index.findMany( keys )
+    return np.array( [index.get( key, -1 ) for key in keys], dtype = np.int64 )
+
+# Whether an array is backed by a memory-mapped file rather than by private memory, following the views it was made from.
+def isMemoryMapped( array ):
+
+    while array is not None:
+        if isinstance( array, ( np.memmap, mmap.mmap ) ):
+            return True
+        array = getattr( array, 'base', None )
+    return False
+
+# Bounded cache that evicts the least recently used entry when full.
+# Counts hits, misses and evictions.
+class lruCache:
+
+    def __init__( self, maxSize ):
+
+        assert maxSize > 0
+        self.maxSize = maxSize # Maximum number of entries [int]
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the value cached for key, calling compute( key ) to obtain and cache it on a miss.
+    def get( self, key, compute ):
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end( key )
+            return self.entries[key]
+
+        self.misses += 1
+        value = compute( key )
+        self.entries[key] = value
+        if len( self.entries ) > self.maxSize:
+            self.entries.popitem( last = False )
+            self.evictions += 1
+        return value
+
+    # Removes the entry of key, if any.
+    def discard( self, key ):
+
+        self.entries.pop( key, None )
+
+    def clear( self ):
+
+        self.entries.clear()
+
+    # The counters and current size, as a dict.
+    def stats( self ):
+
+        return { 'size': len( self.entries ), 'maxSize': self.maxSize, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
 
 # Determines if the given value is equal to the given expected value,
 # within tolerance (used to account for rounding errors in floating-point
 # values)
-def tolerantEquals( val, expected ):
+def tolerantEquals( val, expected, tolerance = errorTolerance ):
 
-    return ( expected - errorTolerance ) <= val <= ( expected + errorTolerance )
+    return ( expected - tolerance ) <= val <= ( expected + tolerance )
 
 # Determines if the values in the given array are equal to the given expected value,
 # within tolerance (used to account for rounding errors in floating-point
 # values)
-def aTolerantEquals( array, expected ):
+def aTolerantEquals( array, expected, tolerance = errorTolerance ):
  
-    return np.all( np.logical_and( np.greater_equal( array, expected - errorTolerance ), np.less_equal( array, expected + errorTolerance ) ) )
+    return np.all( np.logical_and( np.greater_equal( array, expected - tolerance ), np.less_equal( array, expected + tolerance ) ) )
+
+# The tolerance for rounding errors in log-probabilities of the given float type:
+# errorTolerance for float64, a few units of the last place for narrower types.
+def dtypeTolerance( dtype ):
+
+    return max( errorTolerance, 64 * float( np.finfo( dtype ).eps ) )
+
+# The log-probability that stands for a probability of 0 in the given float type: -inf for float64.
+# Narrower types have a much smaller range, so it is a finite value far enough from the lowest value of
+# the type that summing it over the ratings of a user cannot overflow to -inf.
+def logFloor( dtype ):
+
+    if np.dtype( dtype ) == np.float64:
+        return -np.inf
+    return float( np.finfo( dtype ).min ) / 2 ** 20
+
+# Converts log-probabilities to the given float type, raising them to logFloor.
+def narrowLogProbs( P, dtype ):
+
+    return np.maximum( P, logFloor( dtype ) ).astype( dtype, copy = False )
 
 # Calculates part of the likelihood (a single value of y)
 # of a user's ratings.
@@ -53,19 +571,36 @@ def logQ( PY, PR, r ):
 #
 # PY - PY[y] = log P(Y=y)
 # PR - PR[y][j][r] = log P(R_j=r|Y=y)
-# r - r[t][j] = r^t_j - The user's ratings
+# r - The ratings of each user [ratingMatrix]
 # 
 # Returns:
 # - P[t][y] = log P(Y=y)PROD[P(R=r^t|Y=y)]
 def vLogQ( PY, PR, r ):
 
-    ratings = np.equal( r[:,:,np.newaxis], np.arange( PR.shape[2] )[np.newaxis,np.newaxis,:] )
-    PR_picked = ratings[:,np.newaxis,:,:] * PR[np.newaxis,:,:,:]
-    PR_picked[np.isnan( PR_picked )] = 0 # In case of -inf
-    P = PY[np.newaxis,:] + np.sum( PR_picked, axis = ( 2, 3 ) )
+    # Sum of PR[y][j][r^t_j] over the observed ratings only, as a sparse product
+    k, n, S = PR.shape
+    P = PY[np.newaxis,:] + r.indicator( S, PR.dtype ).dot( np.transpose( PR.reshape( ( k, n * S ) ) ) )
     assert np.all( np.less_equal( P, 0 ) )
     return P
 
+# Runs the E step over every user, calculating log q and the evidence
+# from a single evaluation of vLogQ.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# r - The ratings of each user [ratingMatrix]
+#
+# Returns:
+# - qs[t][y] = log P(Y=y)PROD[P(R=r^t|Y=y)], in the float type of PR
+# - P[t] = log P(R=r^t), always summed in float64
+def vEStep( PY, PR, r ):
+
+    qs = vLogQ( PY, PR, r )
+    P = logsumexp( qs.astype( np.float64, copy = False ), axis = 1 )
+    assert np.all( np.less_equal( P, dtypeTolerance( qs.dtype ) ) )
+    return qs, np.minimum( P, 0 )
+
 # Calculates the (log) likelihood of a user's ratings.
 # In other words, calculates log P(R=r(t))
 #
@@ -78,7 +613,7 @@ def vLogQ( PY, PR, r ):
 # - log P(R=r(t))
 def probEvidenceForUser( PY, PR, r ):
 
-    qs = vLogQ( PY, PR, r[np.newaxis,:] ) # Calculate log q for each y
+    qs = vLogQ( PY, PR, ratingMatrix.fromDense( r[np.newaxis,:] ) ) # Calculate log q for each y
     P = logsumexp( qs )
     assert P <= 0
     return P
@@ -89,15 +624,13 @@ def probEvidenceForUser( PY, PR, r ):
 # Parameters:
 # PY - PY[y] = log P(Y=y)
 # PR - PR[y][j][r] = log P(Rj=r|Y=y)
-# r - r[t][j] = r^t_j - The user's ratings
+# r - The ratings of each user [ratingMatrix]
 #
 # Returns:
 # - P[t] = log P(R=r^t)
 def vProbEvidenceForUser( PY, PR, r ):
 
-    qs = vLogQ( PY, PR, r )
-    P = logsumexp( qs, axis = 1 )
-    assert np.all( np.less_equal( P, 0 ) )
+    qs, P = vEStep( PY, PR, r )
     return P
 
 # Calculates the log-likelihood of the current state.
@@ -105,13 +638,13 @@ def vProbEvidenceForUser( PY, PR, r ):
 # Parameters:
 # PY - PY[y] = log P(Y=y)
 # PR - PR[y][j][r] = log P(Rj=r|Y=y) 
-# r - r[t][j] = r^t_j - The ratings of each user
+# r - The ratings of each user [ratingMatrix]
 #
 # Returns:
 # - The log-likelihood
 def logLikelihood( PY, PR, r ):
 
-    P = vProbEvidenceForUser( PY, PR, r )
+    P = [np.sum( vProbEvidenceForUser( PY, PR, block ) ) for block in r.blocks( userBlockSize )]
     L = np.sum( P ) / len( r )
     assert L <= 0
     return L
@@ -131,112 +664,722 @@ def probY( PY, PR, r, y ):
     P = logQ( PY[y], PR[y], r ) - probEvidenceForUser( PY, PR, r )
     assert P <= 0
 
+# Calculates log P(Y=y|{Rj=rj}) for a single user, given only the items they rated,
+# in time proportional to their number of ratings.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# indices - The items rated by the user [int array]
+# scores - The scores given to those items, in the range [0,S) [int array]
+#
+# Returns:
+# - P[y] = log P(Y=y|{Rj=rj})
+def probYForRatings( PY, PR, indices, scores ):
+
+    # Ratings that are impossible under every type say nothing about the type
+    picked = PR[:,indices,scores]
+    picked = picked[:,np.any( np.greater( picked, logFloor( PR.dtype ) ), axis = 0 )]
+    qs = PY + np.sum( picked, axis = 1 )
+    if np.all( np.less_equal( qs, logFloor( PR.dtype ) ) ):
+        qs = PY # Ratings contradict every type, so fall back to the prior
+    P = qs - logsumexp( qs )
+    assert np.all( np.less_equal( P, dtypeTolerance( P.dtype ) ) )
+    return np.minimum( P, 0 )
+
 # Vectorized version of probY over t
 # (y),(y,j,r),(t,j),()->(t)
 #
 # Parameters:
 # PY - PY[y] = log P(Y=y)
 # PR - PR[y][j][r] = log P(Rj=r|Y=y)
-# r - r[j] = r^t_j - The user's ratings
+# r - The ratings of each user [ratingMatrix]
 #
 # Returns:
-# - P[t][y] = log P(Y=y|{R=r^t})
+# - P[t][y] = log P(Y=y|{R=r^t}), in the float type of PR
 def vProbY( PY, PR, r ):
 
-    qs = vLogQ( PY, PR, r )
-    pEv = vProbEvidenceForUser( PY, PR, r )
-    P = qs - pEv[:,np.newaxis]
+    qs, pEv = vEStep( PY, PR, r )
+    P = ( qs - pEv[:,np.newaxis] ).astype( qs.dtype, copy = False )
     assert np.all( np.less_equal( P, 0 ) )
     return P
 
+# Calculates log SUM[exp(v)] over consecutive segments of the last axis of v.
+#
+# Parameters:
+# v - The values to sum
+# starts - The index where each segment starts. Segments may not be empty.
+#
+# Returns:
+# - P[...][i] = log SUM[exp(v[...][starts[i]:starts[i+1]])]
+def segmentLogSumExp( v, starts ):
+
+    M = np.maximum.reduceat( v, starts, axis = -1 )
+    segment = np.repeat( np.arange( len( starts ) ), np.diff( np.append( starts, v.shape[-1] ) ) )
+    return M + np.log( np.add.reduceat( np.exp( v - M[...,segment] ), starts, axis = -1 ) )
+
+# Calculates the sufficient statistics of the M step over a block of users.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# block - The ratings of the users in the block [ratingMatrix]
+#
+# Returns:
+# - logW[y] = log SUM[P(Y=y|{R=r^t})] over the users in the block
+# - logCounts[y][j * S + s] = log SUM[P(Y=y|{R=r^t})] over the users in the block that gave score s to item j
+# - The sum of log P(R=r^t) over the users in the block
+# The sums are taken in float64 whatever the float type of PY and PR, so that they do not lose precision with many users.
+def blockStats( PY, PR, block ):
+
+    k, n, S = PR.shape
+    qs, pEv = vEStep( PY, PR, block )
+    pit = np.transpose( qs.astype( np.float64, copy = False ) - pEv[:,np.newaxis] )
+    assert not np.any( np.isinf( pit ) )
+
+    logCounts = np.full( ( k, n * S ), -np.inf )
+    order, starts, cells = block.cellGroups( S )
+    if block.nnz:
+        logCounts[:,cells] = segmentLogSumExp( pit[:,block.rows()[order]], starts )
+
+    return logsumexp( pit, axis = 1 ), logCounts, np.sum( pEv )
+
+# Combines the sufficient statistics of two disjoint sets of users.
+# Either may be None, meaning an empty set.
+def mergeStats( a, b ):
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return np.logaddexp( a[0], b[0] ), np.logaddexp( a[1], b[1] ), a[2] + b[2]
+
+# Calculates the total posterior weight of the users that did not rate each item,
+# as the total weight minus the weight of the users that did. Where that difference
+# would lose precision (almost every user of a type rated the item), the sum is
+# calculated directly over the users that did not rate the item, in an extra pass
+# over the user blocks.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# r - The ratings of each user [ratingMatrix]
+# pi - pi[y] = log SUM[P(Y=y|{R=r^t})]
+# logRated - logRated[y][j] = log SUM[P(Y=y|{R=r^t})] over the users that rated j
+# blockSize - The number of users to process at once
+# exact - If not None, called instead of exactUnratedWeight with the ( ys, js ) pairs to calculate directly
+#
+# Returns:
+# - P[y][j] = log SUM[P(Y=y|{R=r^t})] over the users that did not rate j
+def logUnratedWeight( PY, PR, r, pi, logRated, blockSize, exact = None ):
+
+    ratedFrac = np.minimum( np.exp( logRated - pi[:,np.newaxis] ), 1.0 )
+    with np.errstate( divide = 'ignore' ):
+        P = pi[:,np.newaxis] + np.log1p( -ratedFrac )
+
+    ys, js = np.nonzero( np.greater( ratedFrac, 1.0 - cancellationTolerance ) )
+    if len( ys ) == 0:
+        return P
+
+    P[ys,js] = exactUnratedWeight( PY, PR, r, ys, js, blockSize ) if exact is None else exact( ys, js )
+    return P
+
+# Calculates the total posterior weight of the users that did not rate item js[i], for type ys[i],
+# directly over those users, one block at a time.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# r - The ratings of each user [ratingMatrix]
+# ys, js - The ( type, item ) pairs [int arrays]
+# blockSize - The number of users to process at once
+#
+# Returns:
+# - P[i] = log SUM[P(Y=ys[i]|{R=r^t})] over the users that did not rate js[i]
+def exactUnratedWeight( PY, PR, r, ys, js, blockSize ):
+
+    exact = np.full( len( ys ), -np.inf )
+    for block in r.blocks( blockSize ):
+
+        pit = np.transpose( vProbY( PY, PR, block ).astype( np.float64, copy = False ) )
+        for j in np.unique( js ):
+
+            unrated = np.ones( block.shape[0], dtype = bool )
+            unrated[block.column( j )] = False
+            if np.any( unrated ):
+                pair = np.flatnonzero( js == j )
+                exact[pair] = np.logaddexp( exact[pair], logsumexp( pit[np.ix_( ys[pair], unrated )], axis = 1 ) )
+
+    return exact
+
 # Runs an iteration of the EM algorithm.
 #
 # Parameters:
 # PY - PY[y] = log P(Y=y)
 # PR - PR[y][j][r] = log P(Rj=r|Y=y) 
-# r - r[t][j] = r^t_j - The ratings of each user
+# r - The ratings of each user [ratingMatrix]
+# blockSize - The number of users to process at once. If None, uses userBlockSize.
+#
+# Returns:
+# - The updated PY
+# - The updated PR
+def update( PY, PR, r, blockSize = None ):
+
+    newPY, newPR, L = emStep( PY, PR, r, blockSize )
+    return newPY, newPR
+
+# Runs an iteration of the EM algorithm, accumulating the sufficient statistics
+# one block of users at a time so that memory use does not depend on the number of users.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y) 
+# r - The ratings of each user [ratingMatrix]
+# blockSize - The number of users to process at once. If None, uses userBlockSize.
 #
 # Returns:
 # - The updated PY
 # - The updated PR
-def update( PY, PR, r ):
+# - The log-likelihood of the given ( not the updated ) PY and PR
+# The updated PY and PR are of the same float type as the given ones.
+def emStep( PY, PR, r, blockSize = None ):
+
+    if blockSize is None:
+        blockSize = userBlockSize
+
+    stats = collectStats( PY, PR, r, blockSize )
+    newPY, newPR = mStep( PY, PR, r, stats, blockSize )
+    return narrowLogProbs( newPY, PY.dtype ), narrowLogProbs( newPR, PR.dtype ), stats[2] / len( r )
+
+# Calculates the sufficient statistics of the M step over every user, one block at a time.
+#
+# Returns:
+# - The statistics, as returned by blockStats
+def collectStats( PY, PR, r, blockSize ):
+
+    stats = None
+    for block in r.blocks( blockSize ):
+
+        stats = mergeStats( stats, blockStats( PY, PR, block ) )
+
+    return stats
+
+# Calculates the expected number of users of each type that would give each score to each item,
+# if every user rated every item: the observed counts, plus the share of the old PR of the users
+# that did not rate the item.
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y) 
+# r - The ratings of each user [ratingMatrix]
+# stats - The sufficient statistics, as returned by blockStats, of all users
+# blockSize - The number of users to process at once
+# exact - See logUnratedWeight
+#
+# Returns:
+# - N[y][j][s] = log of the expected count
+def expectedCounts( PY, PR, r, stats, blockSize, exact = None ):
+
+    k, n, S = PR.shape
+    pi, logCounts, evidence = stats
+    logCounts = logCounts.reshape( ( k, n, S ) )
+    logUnrated = logUnratedWeight( PY, PR, r, pi, logsumexp( logCounts, axis = 2 ), blockSize, exact )
+    return np.logaddexp( logCounts, PR + logUnrated[:,:,np.newaxis] )
+
+# Runs the M step of the EM algorithm, given the sufficient statistics of every user.
+#
+# The new PR is computed from expected counts over the observed ratings only:
+# users that did not rate item j keep contributing their share of the old PR[y][j].
+#
+# Parameters:
+# PY - PY[y] = log P(Y=y)
+# PR - PR[y][j][r] = log P(Rj=r|Y=y) 
+# r - The ratings of each user [ratingMatrix]
+# stats - The sufficient statistics, as returned by blockStats, of all users
+# blockSize - The number of users to process at once
+# exact - See logUnratedWeight
+#
+# Returns:
+# - The updated PY
+# - The updated PR
+def mStep( PY, PR, r, stats, blockSize, exact = None ):
 
     T = r.shape[0]
     k, n, S = PR.shape
-    pit = np.transpose( vProbY( PY, PR, r ) )
-    pi = logsumexp( pit, axis = 1 )
+    pi, logCounts, evidence = stats
     newPY = np.log( 1 / T ) + pi
 
     assert np.all( np.less_equal( PY, 0 ) )
     assert not np.any( np.isnan( PY ) )
     assert not np.any( np.isinf( PY ) )
     
-    assert not np.any( np.isinf( pit ) )
     assert not np.any( np.isinf( pi ) )
-    
-    newPR = np.zeros( ( k, n, S ) )
-    scores = np.transpose( r )
-    unrated = np.equal( scores, -1 )
-    s = np.arange( PR.shape[2] )
-    match = np.equal( scores[:,:,np.newaxis], s[np.newaxis,np.newaxis,:] )
-    notMatch = np.logical_not( np.logical_or( match, unrated[:,:,np.newaxis] ) )
-    notMatchFactor = np.zeros( ( n, T, S ) )
-    notMatchFactor[notMatch] = -np.inf
-    unratedFactor = PR[:,:,np.newaxis,:] * unrated[np.newaxis,:,:,np.newaxis]
-    unratedFactor[np.isnan( unratedFactor )] = 0
-    A = notMatchFactor[np.newaxis,:,:,:] + unratedFactor
-    newPR = logsumexp( pit[:,np.newaxis,:,np.newaxis] + A, axis = 2 )
-    newPR -= pi[:,np.newaxis,np.newaxis]
+
+    newPR = expectedCounts( PY, PR, r, stats, blockSize, exact ) - pi[:,np.newaxis,np.newaxis]
 
     assert not np.any( np.isnan( newPR ) )
-    assert np.all( np.less_equal( newPR, 0 ) )
+    assert np.all( np.less_equal( newPR, dtypeTolerance( PR.dtype ) ) )
+    newPR = np.minimum( newPR, 0 )
 
     return newPY, newPR
 
-# userLists - userLists[t][j] = r^t_j - The ratings of each user
-def runEM( userLists ):
+# Converts a seed into a numpy SeedSequence.
+#
+# Parameters:
+# seed - An int, a string, or a SeedSequence (returned as is)
+def seedSequence( seed ):
 
-    assert np.all( np.logical_or( np.equal( userLists, -1 ), 
-            np.logical_and( np.greater_equal( userLists, 0 ), np.less_equal( userLists, maxScore - minScore + 1 ) ) ) )
+    if isinstance( seed, np.random.SeedSequence ):
+        return seed
+    if isinstance( seed, str ):
+        seed = list( seed.encode( 'utf-8' ) )
+    return np.random.SeedSequence( seed )
+
+# Draws random initial parameters for the EM algorithm.
+# Each PR[y][j] is built by giving every score but the last a random fraction of the
+# remaining probability, and the last score whatever is left.
+#
+# Parameters:
+# n - The number of items
+# seed - The seed to draw from (see seedSequence)
+#
+# Returns:
+# - PY - PY[y] = log P(Y=y), uniform
+# - PR - PR[y][j][r] = log P(Rj=r|Y=y)
+def initialParams( n, seed ):
+
+    rng = np.random.default_rng( seedSequence( seed ) )
+    S = maxScore - minScore + 1
+    fracs = rng.uniform( minInitialProbFrac, maxInitialProbFrac, ( numUserTypes, n, S - 1 ) )
+    remaining = np.cumprod( 1.0 - fracs, axis = 2 )
+
+    PR = np.empty( ( numUserTypes, n, S ) )
+    PR[:,:,0] = fracs[:,:,0]
+    PR[:,:,1:-1] = remaining[:,:,:-1] * fracs[:,:,1:]
+    PR[:,:,-1] = remaining[:,:,-1]
 
-    # Intialize probability of Y and R
     PY = np.full( numUserTypes, np.log( 1 / numUserTypes ) )
-    PR = np.zeros( ( numUserTypes, userLists.shape[1], maxScore - minScore + 1 ) )
-    for i in range( PR.shape[0] ):
+    return PY, np.log( PR )
 
-        for j in range( PR.shape[1] ):
+# Pool of worker processes that run the EM steps over shards of the users (data-parallel EM).
+#
+# The users are split into one contiguous shard per worker, balanced by their number of users and ratings;
+# each worker keeps its shard (and the caches of its blocks) for the life of the pool. On every step, PY and
+# PR are written to a shared memory buffer that every worker reads, and each worker sends back the partial
+# sufficient statistics of its users, which are merged with mergeStats. The results are those of emStep
+# and logLikelihood, up to the rounding of summing the users in a different order.
+#
+# Use it as a context manager, or call close() when done, so that the workers and the buffer are released.
+class emShards:
 
-            remaining = 1.0
-            for s in range( PR.shape[2] - 1 ):
+    # Parameters:
+    # r - The ratings of each user [ratingMatrix]
+    # processes - The number of worker processes (at most one per user). If None, uses every core.
+    # blockSize - The number of users each worker processes at once. If None, uses userBlockSize.
+    # dtype - The float type of PY and PR. If None, uses float64.
+    def __init__( self, r, processes = None, blockSize = None, dtype = None ):
 
-                p = remaining * random.uniform( minInitialProbFrac, maxInitialProbFrac )
-                PR[i][j][s] = p
-                remaining -= p
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if blockSize is None:
+            blockSize = userBlockSize
+        if dtype is None:
+            dtype = np.float64
+        T, n = r.shape
+        shape = ( numUserTypes, n, maxScore - minScore + 1 )
 
-            PR[i][j][PR.shape[2] - 1] = remaining
+        self.r = r
+        self.blockSize = blockSize
+        self.connections = []
+        self.workers = []
 
-    PR = np.log( PR )
+        # Shard boundaries, splitting users + ratings evenly
+        work = r.indptr + np.arange( T + 1 )
+        bounds = np.unique( np.searchsorted( work, np.linspace( 0, work[-1], max( 1, min( processes, T ) ) + 1 ) ) )
+        self.bounds = np.concatenate( ( [0], bounds[np.logical_and( bounds > 0, bounds < T )], [T] ) )
 
-    # Run EM algorithm
-    oldCompletedSteps = 0
-    oldLikelihood = logLikelihood( PY, PR, userLists )
-    for i in range( runs ):
+        self.memory = shared_memory.SharedMemory( create = True, size = np.dtype( dtype ).itemsize * shape[0] * ( 1 + shape[1] * shape[2] ) )
+        self.PY, self.PR = sharedParams( self.memory.buf, shape, dtype )
+        try:
+            context = multiprocessing.get_context()
+            for start, stop in zip( self.bounds[:-1], self.bounds[1:] ):
 
-        PY, PR = update( PY, PR, userLists )
-        likelihood = logLikelihood( PY, PR, userLists )
-        assert likelihood >= oldLikelihood # Ensure likelihood does not decrease
-        oldLikelihood = likelihood
+                connection, child = context.Pipe()
+                worker = context.Process( target = shardWorker, args = ( child, self.memory.name, shape, dtype, r.rowSlice( start, stop ), blockSize ),
+                                          daemon = True )
+                worker.start()
+                child.close()
+                self.connections.append( connection )
+                self.workers.append( worker )
+        except:
+            self.close()
+            raise
+
+    def __enter__( self ):
+
+        return self
+
+    def __exit__( self, excType, excValue, traceback ):
+
+        self.close()
+
+    # Stops the workers and releases the shared buffer.
+    def close( self ):
+
+        for connection in self.connections:
+
+            try:
+                connection.send( None )
+            except OSError:
+                pass
+            connection.close()
+
+        for worker in self.workers:
+
+            worker.join()
+
+        self.connections = []
+        self.workers = []
+        if self.memory is not None:
+            del self.PY, self.PR # Views into the buffer must go before it is closed
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    # Writes PY and PR to the shared buffer, sends a task to every worker and collects their results, in shard order.
+    def run( self, PY, PR, *task ):
+
+        assert self.memory is not None
+        self.PY[...] = PY
+        self.PR[...] = PR
+        for connection in self.connections:
+
+            connection.send( task )
+
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+
+            if isinstance( result, BaseException ):
+                raise result
+        return results
+
+    # Same as collectStats over every user.
+    def collectStats( self, PY, PR ):
+
+        stats = None
+        for part in self.run( PY, PR, 'stats' ):
 
-        completedSteps = int( ( i + 1 ) * 100 / runs )
-        if completedSteps > oldCompletedSteps:
-            print( '%d%% complete' % completedSteps )
-            oldCompletedSteps = completedSteps
+            stats = mergeStats( stats, part )
+
+        return stats
+
+    # Same as exactUnratedWeight over every user.
+    def exactUnratedWeight( self, PY, PR, ys, js ):
+
+        return np.logaddexp.reduce( self.run( PY, PR, 'unrated', ys, js ), axis = 0 )
+
+    # Same as logLikelihood over every user.
+    def logLikelihood( self, PY, PR ):
+
+        L = np.sum( self.run( PY, PR, 'evidence' ) ) / len( self.r )
+        assert L <= 0
+        return L
+
+    # Same as emStep over every user.
+    def emStep( self, PY, PR ):
+
+        stats = self.collectStats( PY, PR )
+        newPY, newPR = mStep( PY, PR, self.r, stats, self.blockSize, lambda ys, js: self.exactUnratedWeight( PY, PR, ys, js ) )
+        return narrowLogProbs( newPY, PY.dtype ), narrowLogProbs( newPR, PR.dtype ), stats[2] / len( self.r )
+
+# Views PY and PR in a shared buffer of parameters, as laid out by emShards.
+def sharedParams( buffer, shape, dtype ):
+
+    params = np.ndarray( ( shape[0] * ( 1 + shape[1] * shape[2] ), ), dtype = dtype, buffer = buffer )
+    return params[:shape[0]], params[shape[0]:].reshape( shape )
+
+# Main loop of an emShards worker: runs the tasks it is sent on its shard, until it is sent None.
+#
+# Parameters:
+# connection - The worker's end of the pipe to the pool
+# name - The name of the shared buffer of parameters
+# shape - The shape of PR, ( k, n, S )
+# dtype - The float type of PY and PR
+# shard - The ratings of the worker's users [ratingMatrix]
+# blockSize - The number of users to process at once
+def shardWorker( connection, name, shape, dtype, shard, blockSize ):
+
+    memory = shared_memory.SharedMemory( name = name )
+    PY, PR = sharedParams( memory.buf, shape, dtype )
+    try:
+        while True:
+
+            task = connection.recv()
+            if task is None:
+                break
+            try:
+                if task[0] == 'stats':
+                    result = collectStats( PY, PR, shard, blockSize )
+                elif task[0] == 'unrated':
+                    result = exactUnratedWeight( PY, PR, shard, task[1], task[2], blockSize )
+                else:
+                    result = sum( np.sum( vProbEvidenceForUser( PY, PR, block ) ) for block in shard.blocks( blockSize ) )
+            except Exception as e:
+                result = e
+            connection.send( result )
+    except EOFError:
+        pass # The pool went away
+    finally:
+        del PY, PR
+        memory.close()
+        connection.close()
+
+# Fits PY and PR to the given ratings with the EM algorithm.
+#
+# Iterates until the log-likelihood stops improving or the maximum number of iterations is reached.
+# The likelihood counts as converged when an iteration improves it by at most absTolerance, or by
+# at most relTolerance times its magnitude, for patience consecutive iterations.
+#
+# Parameters:
+# userLists - The ratings of each user [ratingMatrix]
+# maxIterations - The maximum number of iterations. If None, uses runs.
+# absTolerance - The absolute likelihood tolerance. If None, uses minLikelihoodGain.
+# relTolerance - The relative likelihood tolerance. If None, uses minRelativeLikelihoodGain.
+# patience - The number of consecutive converged iterations needed to stop. If None, uses convergencePatience.
+# seed - The seed of the initial parameters (see seedSequence). If None, uses randomSeed.
+# verbose - Whether to print progress.
+# dtype - The float type of PY and PR, such as compactDtype. If None, uses float64. With a narrower type,
+#         the E step runs in that type but the sufficient statistics are still summed in float64, and
+#         relTolerance is raised to the rounding error of the type (see dtypeTolerance).
+# callback - If not None, called after every iteration with a dict of the 'iteration' number (from 1), the
+#            'likelihood' of the parameters the iteration started from, its 'delta' from the previous one
+#            (None on the first iteration) and the wall time of the iteration in 'seconds'.
+# shards - If more than 1, the number of worker processes to split the users between (see emShards).
+#
+# Returns:
+# - PY - PY[y] = log P(Y=y)
+# - PR - PR[y][j][r] = log P(Rj=r|Y=y)
+# - A report of the run: a dict with the number of 'iterations' ran, the 'likelihood' reached and the
+#   'stopReason' ( 'converged' or 'maxIterations' )
+def runEM( userLists, maxIterations = None, absTolerance = None, relTolerance = None, patience = None, seed = None, verbose = True,
+           dtype = None, callback = None, shards = None ):
 
-    print( 'Final log-likelihood: %.5f' % oldLikelihood )
+    if maxIterations is None:
+        maxIterations = runs
+    if absTolerance is None:
+        absTolerance = minLikelihoodGain
+    if relTolerance is None:
+        relTolerance = minRelativeLikelihoodGain
+    if patience is None:
+        patience = convergencePatience
+    if dtype is None:
+        dtype = np.float64
+    tolerance = dtypeTolerance( dtype )
+    relTolerance = max( relTolerance, tolerance if dtype != np.float64 else 0 )
+
+    assert np.all( np.logical_and( np.greater_equal( userLists.scores, 0 ), np.less( userLists.scores, maxScore - minScore + 1 ) ) )
+
+    # Intialize probability of Y and R
+    PY, PR = initialParams( userLists.shape[1], randomSeed if seed is None else seed )
+    PY, PR = narrowLogProbs( PY, dtype ), narrowLogProbs( PR, dtype )
+
+    # With shards, the steps run over the users in a pool of worker processes (see emShards)
+    pool = emShards( userLists, shards, dtype = dtype ) if shards is not None and shards > 1 else None
+    try:
+        # Run EM algorithm
+        # The E step of each iteration also gives the likelihood of the previous one
+        oldCompletedSteps = 0
+        oldLikelihood = -np.inf
+        converged = 0
+        stopReason = 'maxIterations'
+        iterations = 0
+        while iterations < maxIterations:
+
+            start = time.perf_counter()
+            newPY, newPR, likelihood = emStep( PY, PR, userLists ) if pool is None else pool.emStep( PY, PR )
+            assert likelihood >= oldLikelihood - tolerance * max( 1, abs( likelihood ) ) # Ensure likelihood does not decrease
+            gain = likelihood - oldLikelihood
+            if gain <= absTolerance or gain <= relTolerance * abs( likelihood ):
+                converged += 1
+            else:
+                converged = 0
+            oldLikelihood = likelihood
+            PY, PR = newPY, newPR
+            iterations += 1
+
+            if callback is not None:
+                callback( { 'iteration': iterations, 'likelihood': float( likelihood ), 'delta': float( gain ) if iterations > 1 else None,
+                            'seconds': time.perf_counter() - start } )
+
+            completedSteps = int( iterations * 100 / maxIterations )
+            if verbose and completedSteps > oldCompletedSteps:
+                print( '%d%% complete' % completedSteps )
+                oldCompletedSteps = completedSteps
+
+            if converged >= patience:
+                stopReason = 'converged'
+                break
+
+        likelihood = logLikelihood( PY, PR, userLists ) if pool is None else pool.logLikelihood( PY, PR )
+        assert likelihood >= oldLikelihood - tolerance * max( 1, abs( likelihood ) )
+        oldLikelihood = likelihood
+    finally:
+        if pool is not None:
+            pool.close()
+
+    if verbose:
+        print( 'Stopped after %d iterations (%s)' % ( iterations, stopReason ) )
+        print( 'Final log-likelihood: %.5f' % oldLikelihood )
     
     # Validate output
-    assert tolerantEquals( logsumexp( PY ), 0.0 )
-    a = logsumexp( PR, axis = 2 )
-    assert np.all( np.less_equal( logsumexp( PR, axis = 2 ), errorTolerance ) )
+    assert tolerantEquals( logsumexp( PY ), 0.0, tolerance )
+    assert np.all( np.less_equal( logsumexp( PR, axis = 2 ), tolerance ) )
+
+    return PY, PR, { 'iterations': iterations, 'likelihood': float( oldLikelihood ), 'stopReason': stopReason }
+
+# Runs the EM algorithm from several independently seeded initial parameters, in parallel
+# over a pool of processes, and keeps the run that reached the highest log-likelihood.
+# Restart i always starts from the same parameters for a given seed, regardless of the
+# number of restarts or processes, so results are reproducible.
+#
+# Parameters:
+# userLists - The ratings of each user [ratingMatrix]
+# restarts - The number of runs. If None, uses emRestarts.
+# seed - The base seed (see seedSequence). If None, uses randomSeed.
+# processes - The maximum number of worker processes. If None, uses every core.
+# Other keyword arguments are passed to runEM, except that with several restarts, verbose only prints the
+# best run, not the progress of each. A callback is only called for runs in this process
+# ( a single restart, or processes = 1 ), with the index of the run added as 'restart'.
+#
+# Returns:
+# - PY, PR and the report of the best run, as returned by runEM. The report also includes the
+#   index of the best run ( 'restart' ) and the final likelihood of every run ( 'likelihoods' ).
+def runEMRestarts( userLists, restarts = None, seed = None, processes = None, **kwargs ):
+
+    if restarts is None:
+        restarts = emRestarts
+    if seed is None:
+        seed = randomSeed
+    seeds = seedSequence( seed ).spawn( restarts )
+    callback = kwargs.pop( 'callback', None )
+    verbose = kwargs.pop( 'verbose', True )
+
+    if restarts == 1 or processes == 1:
+        results = [runEM( userLists, seed = s, verbose = verbose and restarts == 1, **kwargs,
+                          callback = None if callback is None else ( lambda progress, i = i: callback( dict( progress, restart = i ) ) ) )
+                   for i, s in enumerate( seeds )]
+    else:
+        workers = min( restarts, processes or os.cpu_count() or 1 )
+        with ProcessPoolExecutor( max_workers = workers ) as pool:
+            futures = [pool.submit( runEM, userLists, seed = s, verbose = False, **kwargs ) for s in seeds]
+            results = [f.result() for f in futures]
+
+    likelihoods = [report['likelihood'] for PY, PR, report in results]
+    best = int( np.argmax( likelihoods ) )
+    PY, PR, report = results[best]
+    report = dict( report, restart = best, likelihoods = likelihoods )
+    if verbose and restarts > 1:
+        print( 'Best of %d runs: run %d, log-likelihood %.5f' % ( restarts, best, report['likelihood'] ) )
+
+    return PY, PR, report
+
+# Measures the accuracy lost by fitting in compactDtype instead of float64, on users held out of the fit.
+#
+# Parameters:
+# train - The ratings of the users to fit on [ratingMatrix]
+# test - The ratings of the held-out users, over the same items [ratingMatrix]
+# Other keyword arguments are passed to runEM.
+#
+# Returns:
+# - A dict with the held-out log-likelihood per user of the float64 fit and of the compact fit ( 'likelihood64' and
+#   'likelihoodCompact' ), their difference ( 'likelihoodDifference' ), and the largest difference in P(Y=y|R) of the
+#   held-out users between the float64 fit and the same parameters rounded to compactDtype ( 'maxPosteriorError' ).
+#   The latter is the error of serving a float64 model in compact mode, without the effect of fitting in compactDtype.
+def compactReport( train, test, **kwargs ):
+
+    kwargs.setdefault( 'verbose', False )
+    PY, PR, report = runEM( train, **kwargs )
+    cPY, cPR, cReport = runEM( train.compact(), dtype = compactDtype, **kwargs )
+
+    likelihood64 = float( logLikelihood( PY, PR, test ) )
+    likelihoodCompact = float( logLikelihood( cPY.astype( np.float64 ), cPR.astype( np.float64 ), test ) )
+    posteriors = vProbY( PY, PR, test )
+    rounded = vProbY( narrowLogProbs( PY, compactDtype ), narrowLogProbs( PR, compactDtype ), test.compact() )
+
+    return { 'likelihood64': likelihood64, 'likelihoodCompact': likelihoodCompact,
+             'likelihoodDifference': likelihoodCompact - likelihood64,
+             'maxPosteriorError': float( np.max( np.abs( np.exp( posteriors ) - np.exp( rounded ) ) ) ) if len( test ) else 0.0 }
+
+# Stepwise (online) EM: updates fitted PY and PR from mini-batches of users, without going over
+# every user again.
+#
+# Keeps the expected sufficient statistics per user, W[y] = P(Y=y) and N[y][j][s] = P(Y=y)P(Rj=s|Y=y).
+# Each batch runs the same E step and expected counts as update, over the batch's users only, and
+# moves the statistics towards those of the batch by a step size that decays with the number of
+# users seen: eta = ( U / B + 2 )^-stepDecay, where B is the number of users in the batch and U the
+# number the statistics already stand for (the users PY and PR were fitted to, plus those of every
+# batch so far). U / B is what the statistics are worth in batches of this size, so with batches of
+# equal size eta decays with the number of batches seen, and with stepDecay in (0.5,1] the updates
+# converge; a small batch only nudges a model fitted to many users.
+# A batch must hold the full current ratings of users that are new or whose ratings changed.
+class onlineEM:
+
+    # Parameters:
+    # PY, PR - The fitted parameters to start from
+    # stepDecay - The decay of the step size. If None, uses onlineStepDecay.
+    # users - The number of users PY and PR were fitted to, or 0 to let the first batch replace them.
+    def __init__( self, PY, PR, stepDecay = None, users = 0 ):
+
+        self.logW = np.array( PY ) # log W[y] [float array, k]
+        self.logN = PY[:,np.newaxis,np.newaxis] + PR # log N[y][j][s] [float array, k x n x S]
+        self.stepDecay = onlineStepDecay if stepDecay is None else stepDecay # [float]
+        self.users = users # Number of users the statistics stand for [int]
+        self.batches = 0 # Number of batches seen [int]
+        self.PY = np.array( PY ) # The current PY
+        self.PR = np.array( PR ) # The current PR
+
+    # Updates PY and PR from a batch of users.
+    #
+    # Parameters:
+    # batch - The ratings of the users in the batch [ratingMatrix]
+    # blockSize - The number of users to process at once. If None, uses userBlockSize.
+    #
+    # Returns:
+    # - The updated PY
+    # - The updated PR
+    # - The log-likelihood of the batch under the PY and PR before the update (leaving out scores
+    #   that were impossible under every type)
+    def update( self, batch, blockSize = None ):
+
+        if blockSize is None:
+            blockSize = userBlockSize
+        assert batch.shape[1] == self.PR.shape[1]
+        assert len( batch ) > 0
+        assert np.all( np.logical_and( np.greater_equal( batch.scores, 0 ), np.less( batch.scores, self.PR.shape[2] ) ) )
+
+        # A score never seen before for an item is impossible under every type. It says nothing
+        # about the type of the user, so it is left out of the E step (as log 1 under every type),
+        # but it is still counted
+        impossible = np.all( np.less_equal( self.PR, logFloor( self.PR.dtype ) ), axis = 0 )
+        PR = np.where( impossible[np.newaxis,:,:], 0.0, self.PR )
+
+        stats = collectStats( self.PY, PR, batch, blockSize )
+        logB = np.log( len( batch ) )
+        batchW = stats[0] - logB
+        batchN = expectedCounts( self.PY, PR, batch, stats, blockSize )
+        batchN[:,impossible] = stats[1].reshape( batchN.shape )[:,impossible]
+        batchN -= logB
+
+        eta = ( self.users / len( batch ) + 2 ) ** -self.stepDecay
+        self.logW = np.logaddexp( np.log1p( -eta ) + self.logW, np.log( eta ) + batchW )
+        self.logN = np.logaddexp( np.log1p( -eta ) + self.logN, np.log( eta ) + batchN )
+        self.users += len( batch )
+        self.batches += 1
+
+        dtype = self.PR.dtype
+        self.PY = narrowLogProbs( self.logW - logsumexp( self.logW ), dtype )
+        self.PR = narrowLogProbs( np.minimum( self.logN - self.logW[:,np.newaxis,np.newaxis], 0 ), dtype )
+        assert not np.any( np.isnan( self.PR ) )
+        assert tolerantEquals( logsumexp( self.PY ), 0.0, dtypeTolerance( dtype ) )
 
-    return PY, PR
+        return self.PY, self.PR, float( stats[2] / len( batch ) )
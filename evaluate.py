@@ -0,0 +1,256 @@
+# Held-out evaluation of the engine.
+#
+# Scores a set of ratings that the model was not fitted on and reports how well the predicted score distributions
+# match them:
+# - logLoss: The mean of -log P(actual score), in nats.
+# - accuracy: The fraction of ratings where the most likely score is the actual one.
+# - meanAbsoluteError: The mean of |expected score - actual score|.
+# - calibration: A reliability table of every predicted probability (10 per rating) in equal-width bins, with the mean
+#   predicted probability and the observed frequency of each bin, and its summary, the expectedCalibrationError (the
+#   mean |predicted - observed| of the bins, weighted by their count).
+#
+# The probabilities are the same as those of scoreDistribution, but computed for a whole chunk of ratings at once:
+# the probability of each score given each user type is tabulated once per show, so each rating only takes a product
+# of its user's type posterior with its show's row. Chunks are scored in parallel by worker processes, which are given
+# the tabulated probabilities and the user type posteriors when they start.
+#
+# Examples:
+#   python evaluate.py model heldout.csv --processes 8
+# or, from Python, fitting on a random 90% of the scores and evaluating on the rest:
+#   report = evaluate.trainAndEvaluate( animeList, scores, fraction = 0.1 )
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import engine
+import metrics
+from batch_predict import parseQuery, readQueries
+from engine_helpers import findKeys
+
+calibrationBins = 10 # Number of equal-width probability bins of the reliability table
+probabilityFloor = np.finfo( np.float64 ).tiny # Probabilities that underflow to 0 are raised to this, so that log-loss stays finite
+
+typeScores = None # typeScores[i][y][s] = P(R=s|Y=y) for anime i, as tabulated by tabulateTypeScores [float array]
+
+# Splits scores at random into a training and a held-out set.
+#
+# Parameters:
+# - scores: The scores, as given to engine.initialize: a list of tuples or scoreColumns.
+# - fraction: The expected fraction of the scores to hold out.
+# - seed: The random seed.
+#
+# Return:
+# - The training scores and the held-out scores, of the same kind as the scores given.
+def splitScores( scores, fraction=0.1, seed=0 ):
+
+    heldOut = np.random.default_rng( seed ).random( len( scores ) ) < fraction
+    if isinstance( scores, engine.scoreColumns ):
+        return tuple( engine.scoreColumns( scores.userNames, scores.userCodes[mask], scores.titleNames, scores.titleCodes[mask],
+                                           scores.scores[mask] ) for mask in ( ~heldOut, heldOut ) )
+
+    return [s for s, held in zip( scores, heldOut ) if not held], [s for s, held in zip( scores, heldOut ) if held]
+
+# Converts held-out scores to engine indices. Each column is factorized first, so that every distinct user and title
+# is looked up once, in bulk.
+#
+# Parameters:
+# - scores: A list of tuples (username, title, score) or scoreColumns.
+#
+# Return:
+# - The user index, the anime index and the score of each held-out score [int arrays]. Unknown users and titles have index -1.
+def encodeScores( scores ):
+
+    if isinstance( scores, engine.scoreColumns ):
+        # Only the codes in use: held-out columns share the name lists of every score
+        userCodes, userInverse = np.unique( scores.userCodes, return_inverse = True )
+        userMap = findKeys( engine.users, [str( scores.userNames[c] ) for c in userCodes] )
+        if scores.titleNames is engine.animeTitles:
+            return userMap[userInverse], scores.titleCodes.astype( np.int64 ), scores.scores.astype( np.int64 )
+        titleCodes, titleInverse = np.unique( scores.titleCodes, return_inverse = True )
+        titleMap = findKeys( engine.animes, [str( scores.titleNames[c] ) for c in titleCodes] )
+        return userMap[userInverse], titleMap[titleInverse], scores.scores.astype( np.int64 )
+
+    userNames, userInverse = np.unique( np.array( [str( u ) for u, t, s in scores], dtype = str ), return_inverse = True )
+    titleNames, titleInverse = np.unique( np.array( [str( t ) for u, t, s in scores], dtype = str ), return_inverse = True )
+    values = np.array( [int( s ) for u, t, s in scores], dtype = np.int64 )
+    assert np.all( np.logical_and( values >= engine.minScore, values <= engine.maxScore ) )
+    return findKeys( engine.users, userNames )[userInverse], findKeys( engine.animes, titleNames )[titleInverse], values
+
+# Tabulates, for every anime, the probability of each score given each user type, from the fitted tag model.
+#
+# Return:
+# - T[i][y][s] = P(R=minScore+s|Y=y) for anime i [float array]
+def tabulateTypeScores():
+
+    k = engine.PR_tag_linear.shape[0]
+    S = engine.maxScore - engine.minScore + 1
+    byTag = np.transpose( np.reshape( engine.PR_tag_linear, ( k, -1, S ) ), ( 1, 0, 2 ) ).reshape( ( -1, k * S ) )
+    return np.asarray( engine.animeTagMatrix.dot( byTag ) ).reshape( ( -1, k, S ) )
+
+# Sets the arrays that chunkSums needs in a worker process. Workers started with spawn (the only start method on
+# Windows) do not inherit the engine state of the parent process.
+def initWorker( scores, PY_tag_user ):
+
+    global typeScores
+
+    typeScores = scores
+    engine.PY_tag_user = PY_tag_user
+
+# Calculates the probability of each score for a batch of ( user, anime ) pairs, all of which must be known.
+#
+# Return:
+# - P[m][s] = probability of score minScore + s for pair m [float array]
+def predictBatch( userIndices, animeIndices ):
+
+    weights = np.exp( engine.PY_tag_user[userIndices].astype( np.float64, copy = False ) )
+    return np.einsum( 'my,mys->ms', weights, typeScores[animeIndices] )
+
+# Calculates the sums behind each metric over a chunk of held-out scores, so that chunks can be combined by adding them.
+#
+# Parameters:
+# - chunk: The user indices, anime indices and scores of the chunk [tuple of int arrays]. Every user and anime must be known.
+#
+# Return:
+# - The sums [map of string to number or float array]
+def chunkSums( chunk ):
+
+    userIndices, animeIndices, values = chunk
+    P = predictBatch( userIndices, animeIndices )
+    scores = np.arange( engine.minScore, engine.maxScore + 1 )
+    actual = values - engine.minScore
+    rows = np.arange( len( values ) )
+
+    # Each predicted probability, and whether its score was the actual one, binned by the probability
+    outcomes = np.zeros( P.shape )
+    outcomes[rows,actual] = 1
+    bins = np.minimum( ( P * calibrationBins ).astype( np.int64 ), calibrationBins - 1 ).ravel()
+
+    return { 'count': len( values ),
+             'logLoss': float( -np.sum( np.log( np.maximum( P[rows,actual], probabilityFloor ) ) ) ),
+             'correct': int( np.sum( np.argmax( P, axis = 1 ) == actual ) ),
+             'absoluteError': float( np.sum( np.abs( P.dot( scores ) - values ) ) ),
+             'binCounts': np.bincount( bins, minlength = calibrationBins ),
+             'binPredicted': np.bincount( bins, weights = P.ravel(), minlength = calibrationBins ),
+             'binObserved': np.bincount( bins, weights = outcomes.ravel(), minlength = calibrationBins ) }
+
+# Turns the sums of every chunk into the metrics.
+def summarize( sums, skipped ):
+
+    count = sums['count']
+    binCounts = sums['binCounts']
+    nonEmpty = binCounts > 0
+    predicted = np.where( nonEmpty, sums['binPredicted'] / np.maximum( binCounts, 1 ), np.nan )
+    observed = np.where( nonEmpty, sums['binObserved'] / np.maximum( binCounts, 1 ), np.nan )
+    edges = np.linspace( 0, 1, calibrationBins + 1 )
+
+    return { 'ratings': int( count ), 'skipped': int( skipped ),
+             'logLoss': sums['logLoss'] / count if count else None,
+             'accuracy': sums['correct'] / count if count else None,
+             'meanAbsoluteError': sums['absoluteError'] / count if count else None,
+             'expectedCalibrationError': float( np.sum( binCounts[nonEmpty] * np.abs( predicted - observed )[nonEmpty] ) / np.sum( binCounts ) )
+                                         if count else None,
+             'calibration': [{ 'bin': '[%g,%g)' % ( edges[b], edges[b + 1] ), 'count': int( binCounts[b] ),
+                               'meanPredicted': float( predicted[b] ), 'observed': float( observed[b] ) }
+                             for b in range( calibrationBins ) if nonEmpty[b]] }
+
+# Evaluates the engine on held-out scores. Scores of users or titles the engine does not know are skipped.
+#
+# Parameters:
+# - scores: The held-out scores: a list of tuples (username, title, score) or scoreColumns.
+# - processes: The number of worker processes. If None, uses every core; if 1, runs in this process.
+# - chunkSize: The number of scores processed at once by a process.
+#
+# Return:
+# - The metrics [dict], see the top of this file, with the number of 'ratings' scored and 'skipped'.
+def evaluate( scores, processes=None, chunkSize=16384 ):
+
+    global typeScores
+
+    with metrics.phase( 'evaluate' ):
+        userIndices, animeIndices, values = encodeScores( scores )
+        known = np.logical_and( userIndices >= 0, animeIndices >= 0 )
+        userIndices, animeIndices, values = userIndices[known], animeIndices[known], values[known]
+        chunks = [( userIndices[start:start + chunkSize], animeIndices[start:start + chunkSize], values[start:start + chunkSize] )
+                  for start in range( 0, len( values ), chunkSize )]
+
+        typeScores = tabulateTypeScores()
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min( processes, len( chunks ) )
+
+        if processes > 1:
+            with ProcessPoolExecutor( max_workers = processes, initializer = initWorker, initargs = ( typeScores, engine.PY_tag_user ) ) as pool:
+                parts = list( pool.map( chunkSums, chunks ) )
+        else:
+            parts = [chunkSums( chunk ) for chunk in chunks]
+
+        sums = { 'count': 0, 'logLoss': 0.0, 'correct': 0, 'absoluteError': 0.0, 'binCounts': np.zeros( calibrationBins, dtype = np.int64 ),
+                 'binPredicted': np.zeros( calibrationBins ), 'binObserved': np.zeros( calibrationBins ) }
+        for part in parts:
+
+            for key in sums:
+
+                sums[key] = sums[key] + part[key]
+
+        return summarize( sums, len( known ) - np.count_nonzero( known ) )
+
+# Fits the engine on a random part of the scores and evaluates it on the rest.
+#
+# Parameters:
+# - animeList: The animes, as given to engine.initialize.
+# - scores: The scores, as given to engine.initialize.
+# - fraction: The expected fraction of the scores to hold out.
+# - seed: The random seed of the split.
+# - processes: See evaluate.
+# Other keyword arguments are passed to engine.initialize.
+#
+# Return:
+# - The metrics, as returned by evaluate.
+def trainAndEvaluate( animeList, scores, fraction=0.1, seed=0, processes=None, **kwargs ):
+
+    train, test = splitScores( scores, fraction, seed )
+    engine.initialize( animeList, train, **kwargs )
+    return evaluate( test, processes )
+
+def main( argv=None ):
+
+    parser = argparse.ArgumentParser( description = 'Evaluates a saved model on held-out scores.' )
+    parser.add_argument( 'model', help = 'model directory written by engine.saveModel' )
+    parser.add_argument( 'input', help = 'CSV or JSON lines file of held-out scores (user, title, score), or - for the standard input' )
+    parser.add_argument( '--format', choices = [ 'csv', 'jsonl' ], help = 'input format. If not given, taken from the input file extension' )
+    parser.add_argument( '--processes', type = int, help = 'number of worker processes. Defaults to every core' )
+    parser.add_argument( '--chunk-size', type = int, default = 16384, help = 'number of scores processed at once' )
+    args = parser.parse_args( argv )
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'jsonl' if args.input.endswith( ( '.jsonl', '.json' ) ) else 'csv'
+
+    # Rows that are malformed or have no score in the range are counted, not scored
+    inFile = sys.stdin if args.input == '-' else open( args.input, newline = '' )
+    scores = []
+    malformed = 0
+    try:
+        for query in readQueries( inFile, fmt ):
+
+            try:
+                user, title, score = parseQuery( query )
+            except ValueError:
+                score = None
+            if score is None or not engine.minScore <= score <= engine.maxScore:
+                malformed += 1
+            else:
+                scores.append( ( user, title, score ) )
+    finally:
+        if inFile is not sys.stdin:
+            inFile.close()
+
+    engine.loadModel( args.model )
+    report = evaluate( scores, args.processes, args.chunk_size )
+    report['malformed'] = malformed
+    print( json.dumps( report, indent = 2 ) )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# Instrumentation of the engine: phase timers, EM progress and scoring latencies, sent as events to pluggable sinks.
+#
+# An event is a dict with an 'event' key ( 'phase', 'emIteration' or 'latency' ) and the values measured. A sink is any
+# callable taking an event: loggingSink, jsonLinesSink and registry are provided. With no sinks added (the default),
+# nothing is measured, and the instrumented functions only pay for checking that the list of sinks is empty.
+import functools
+import json
+import logging
+import threading
+import time
+import numpy as np
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+sinks = [] # The sinks events are sent to [list of callable]
+
+# Adds a sink.
+#
+# Return:
+# - The sink, so that it can be removed later.
+def addSink( sink ):
+
+    sinks.append( sink )
+    return sink
+
+def removeSink( sink ):
+
+    sinks.remove( sink )
+
+def emit( event ):
+
+    for sink in sinks:
+
+        sink( event )
+
+# The peak resident memory of the process so far, in kilobytes (on Linux), or None where it cannot be measured.
+def maxRss():
+
+    if resource is None:
+        return None
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+# Times a block of code as a named phase, e.g. "with phase( 'initialize.animeEM' ):". Sends a 'phase' event with
+# the wall time and the peak resident memory of the process at the end of the phase.
+class phase:
+
+    def __init__( self, name ):
+
+        self.name = name
+        self.start = None
+
+    def __enter__( self ):
+
+        if sinks:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__( self, excType, excValue, traceback ):
+
+        if self.start is not None and sinks:
+            emit( { 'event': 'phase', 'name': self.name, 'seconds': time.perf_counter() - self.start, 'maxRssKilobytes': maxRss(),
+                    'failed': excType is not None } )
+
+# Decorates a function so that the latency of each call is sent as a 'latency' event with the given name.
+def timed( name ):
+
+    def decorate( function ):
+
+        @functools.wraps( function )
+        def wrapper( *args, **kwargs ):
+
+            if not sinks:
+                return function( *args, **kwargs )
+            start = time.perf_counter()
+            result = function( *args, **kwargs )
+            emit( { 'event': 'latency', 'name': name, 'seconds': time.perf_counter() - start } )
+            return result
+
+        return wrapper
+
+    return decorate
+
+# Makes a callback for runEM that sends each iteration as an 'emIteration' event, or None if there are no sinks.
+#
+# Parameters:
+# - name: The name of the EM run, e.g. 'anime' or 'tag'.
+def emCallback( name ):
+
+    if not sinks:
+        return None
+    return lambda progress: emit( dict( progress, event = 'emIteration', name = name ) )
+
+# Sink that logs every event.
+#
+# Parameters:
+# - logger: The logger to use. If None, uses the logger of this module.
+# - level: The level to log at.
+def loggingSink( logger=None, level=logging.INFO ):
+
+    if logger is None:
+        logger = logging.getLogger( __name__ )
+    return lambda event: logger.log( level, '%s', json.dumps( event ) )
+
+# Sink that writes every event as a line of JSON to a file.
+#
+# Parameters:
+# - out: A file opened for writing (text).
+def jsonLinesSink( out ):
+
+    def sink( event ):
+
+        out.write( json.dumps( event ) + '\n' )
+        out.flush()
+
+    return sink
+
+# Histogram of latencies in fixed, logarithmically spaced buckets (1, 2 and 5 times each power of 10, from 1 microsecond
+# to 100 seconds), so that it takes constant memory however many latencies it counts.
+class latencyHistogram:
+
+    edges = np.array( [m * 10.0 ** e for e in range( -6, 2 ) for m in ( 1, 2, 5 )] + [100.0] ) # Upper bucket bounds, in seconds
+
+    def __init__( self ):
+
+        self.counts = np.zeros( len( self.edges ) + 1, dtype = np.int64 ) # The last bucket counts latencies over 100 seconds
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add( self, seconds ):
+
+        self.counts[np.searchsorted( self.edges, seconds )] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max( self.max, seconds )
+
+    # The upper bound of the bucket holding the q-th quantile of the latencies ( q in [0,1] ), or None if there are none.
+    def quantile( self, q ):
+
+        if self.count == 0:
+            return None
+        i = int( np.searchsorted( np.cumsum( self.counts ), q * self.count ) )
+        return float( self.edges[i] ) if i < len( self.edges ) else self.max
+
+    # The histogram as a dict: the count, mean, max, the p50, p90 and p99 bucket bounds, and the non-empty buckets.
+    def summary( self ):
+
+        return { 'count': self.count, 'mean': self.total / self.count if self.count else None, 'max': self.max,
+                 'p50': self.quantile( 0.5 ), 'p90': self.quantile( 0.9 ), 'p99': self.quantile( 0.99 ),
+                 'buckets': { ( '%g' % self.edges[i] if i < len( self.edges ) else 'inf' ): int( c )
+                              for i, c in enumerate( self.counts ) if c } }
+
+# Sink that keeps the events in memory: the last time of each phase, the EM iterations of each run and a histogram
+# of the latencies of each name. Events may be sent and snapshots taken from different threads.
+class registry:
+
+    def __init__( self ):
+
+        self.phases = {} # The last 'phase' event of each name [map of string to dict]
+        self.emIterations = {} # The 'emIteration' events of each EM run [map of string to list of dict]
+        self.latencies = {} # The latencies of each name [map of string to latencyHistogram]
+        self.lock = threading.Lock() # Held while recording an event or taking a snapshot
+
+    def __call__( self, event ):
+
+        with self.lock:
+            self.record( event )
+
+    def record( self, event ):
+
+        kind = event['event']
+        if kind == 'phase':
+            self.phases[event['name']] = event
+        elif kind == 'emIteration':
+            self.emIterations.setdefault( event['name'], [] ).append( event )
+        elif kind == 'latency':
+            if event['name'] not in self.latencies:
+                self.latencies[event['name']] = latencyHistogram()
+            self.latencies[event['name']].add( event['seconds'] )
+
+    # Everything recorded, as a dict that can be written as JSON.
+    def snapshot( self ):
+
+        with self.lock:
+            return { 'phases': dict( self.phases ), 'emIterations': { name: list( events ) for name, events in self.emIterations.items() },
+                     'latencies': { name: h.summary() for name, h in self.latencies.items() } }
@@ -0,0 +1,300 @@
+# HTTP prediction service over a model saved with engine.saveModel.
+#
+# Runs on asyncio with only the standard library. The model is loaded in the background at startup, so the service
+# answers health checks while it loads; scoring runs on a single worker thread (the engine is not thread-safe), so a
+# slow request never blocks the event loop, and every request is answered within its timeout. Connections are kept
+# open between requests (HTTP keep-alive) unless the client asks to close them.
+#
+# With --workers N, N worker processes share the listening socket, each with its own event loop and engine thread.
+# Each loads the model memory-mapped (see engine.loadModel), so they share a single copy of it. /ready and /metrics
+# then report on the worker that answers.
+#
+# Endpoints (GET, JSON responses):
+# - /health: Always 200 while the process is up.
+# - /ready: 200 once the model is loaded, 503 before (or if loading failed).
+# - /distribution?user=U&title=T: The probability of each score, the expected and the most likely score.
+# - /score?user=U&title=T&score=S: The probability of the given score.
+# - /recommend?user=U&n=N[&excludeRated=0][&atLeast=S]: The top N shows for the user, see engine.recommend.
+# - /metrics: The latency histograms of every endpoint and engine call, see metrics.registry.
+#
+# Example:
+#   python server.py model --port 8080 --timeout 1.0 --workers 4
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import engine
+import metrics
+
+maxHeaderBytes = 16384 # Longest request head accepted
+headerTimeout = 10.0 # Seconds a client has to send the request head, and the longest a kept-alive connection stays idle
+
+# An error answered with the given HTTP status and message.
+class requestError( Exception ):
+
+    def __init__( self, status, message ):
+
+        super().__init__( message )
+        self.status = status
+
+# The prediction service. Create it, then run serve().
+class predictionServer:
+
+    # Parameters:
+    # - modelPath: The model to load, see engine.loadModel.
+    # - timeout: The longest time, in seconds, to spend on a request before answering 504.
+    # - cacheSize: The number of users to cache the tag marginals of, see engine.enableMarginalCache. 0 disables it.
+    def __init__( self, modelPath, timeout=1.0, cacheSize=1024 ):
+
+        self.modelPath = modelPath
+        self.timeout = timeout
+        self.cacheSize = cacheSize
+        self.ready = False
+        self.loadError = None
+        self.loading = None # The future of the model load
+        self.executor = ThreadPoolExecutor( max_workers = 1 ) # Every engine call runs here, one at a time
+        self.registry = metrics.addSink( metrics.registry() )
+        self.routes = { '/health': self.health, '/ready': self.readiness, '/distribution': self.distribution,
+                        '/score': self.score, '/recommend': self.recommend, '/metrics': self.latencies }
+
+    def load( self ):
+
+        try:
+            engine.loadModel( self.modelPath )
+            engine.enableMarginalCache( self.cacheSize )
+            self.ready = True
+        except Exception as e:
+            self.loadError = repr( e )
+            raise
+
+    # Starts loading the model and serves until cancelled.
+    #
+    # Parameters:
+    # - host, port: The address to listen on.
+    # - sock: A listening socket to serve on instead, shared with other worker processes (see serveWorkers).
+    async def serve( self, host=None, port=None, sock=None ):
+
+        loop = asyncio.get_running_loop()
+        self.loading = loop.run_in_executor( self.executor, self.load )
+        if sock is None:
+            server = await asyncio.start_server( self.handle, host, port, limit = maxHeaderBytes )
+            print( 'Serving on %s' % ', '.join( str( s.getsockname() ) for s in server.sockets ) )
+        else:
+            server = await asyncio.start_server( self.handle, sock = sock, limit = maxHeaderBytes )
+        async with server:
+            await server.serve_forever()
+
+    # Answers the requests on a connection, one at a time, until the client closes it, asks to close it or leaves it
+    # idle for headerTimeout.
+    async def handle( self, reader, writer ):
+
+        try:
+            keepAlive = True
+            while keepAlive:
+
+                try:
+                    head = await asyncio.wait_for( reader.readuntil( b'\r\n\r\n' ), headerTimeout )
+                except ( asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError ):
+                    return
+
+                start = time.perf_counter()
+                path = None
+                keepAlive = False
+                try:
+                    method, target = parseRequestLine( head )
+                    keepAlive = keepAliveRequested( head )
+                    if method != 'GET':
+                        raise requestError( HTTPStatus.METHOD_NOT_ALLOWED, 'Only GET is supported' )
+
+                    url = urlsplit( target )
+                    path = url.path
+                    if path not in self.routes:
+                        raise requestError( HTTPStatus.NOT_FOUND, 'Unknown endpoint %s' % path )
+                    query = { k: v[-1] for k, v in parse_qs( url.query ).items() }
+                    status, body = await asyncio.wait_for( self.routes[path]( query ), self.timeout )
+                except requestError as e:
+                    status, body = e.status, { 'error': str( e ) }
+                except asyncio.TimeoutError:
+                    status, body = HTTPStatus.GATEWAY_TIMEOUT, { 'error': 'Timed out' }
+                except Exception as e:
+                    status, body = HTTPStatus.INTERNAL_SERVER_ERROR, { 'error': repr( e ) }
+
+                payload = json.dumps( body ).encode( 'utf-8' )
+                writer.write( ( 'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n'
+                                % ( status, HTTPStatus( status ).phrase, len( payload ), 'keep-alive' if keepAlive else 'close' ) ).encode( 'latin-1' )
+                              + payload )
+                await writer.drain()
+                if path in self.routes:
+                    self.registry( { 'event': 'latency', 'name': 'http' + path, 'seconds': time.perf_counter() - start } )
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # Runs an engine call on the worker thread.
+    async def call( self, function, *args ):
+
+        if not self.ready:
+            raise requestError( HTTPStatus.SERVICE_UNAVAILABLE, 'Model not loaded' )
+        return await asyncio.get_running_loop().run_in_executor( self.executor, function, *args )
+
+    async def health( self, query ):
+
+        return HTTPStatus.OK, { 'status': 'ok' }
+
+    async def readiness( self, query ):
+
+        if self.ready:
+            return HTTPStatus.OK, { 'ready': True, 'users': len( engine.users ), 'titles': len( engine.animes ) }
+        return HTTPStatus.SERVICE_UNAVAILABLE, { 'ready': False, 'error': self.loadError }
+
+    async def distribution( self, query ):
+
+        user, title = requireParams( query, 'user', 'title' )
+        result = await self.call( engine.scoreDistribution, user, title )
+        if result is None:
+            raise requestError( HTTPStatus.NOT_FOUND, 'Unknown user or title' )
+
+        P, expected, mostLikely = result
+        return HTTPStatus.OK, { 'user': user, 'title': title, 'probabilities': np.exp( P ).tolist(), 'expected': expected,
+                                'mostLikely': mostLikely }
+
+    async def score( self, query ):
+
+        user, title, score = requireParams( query, 'user', 'title', 'score' )
+        score = intParam( score, 'score' )
+        if not ( engine.minScore <= score <= engine.maxScore ):
+            raise requestError( HTTPStatus.BAD_REQUEST, 'score must be in the range [%d,%d]' % ( engine.minScore, engine.maxScore ) )
+
+        P = await self.call( engine.scoreProb, user, score, title )
+        if P is None:
+            raise requestError( HTTPStatus.NOT_FOUND, 'Unknown user or title' )
+        return HTTPStatus.OK, { 'user': user, 'title': title, 'score': score, 'probability': float( np.exp( P ) ) }
+
+    async def recommend( self, query ):
+
+        user, = requireParams( query, 'user' )
+        n = intParam( query.get( 'n', '10' ), 'n' )
+        excludeRated = query.get( 'excludeRated', '1' ) not in ( '0', 'false', 'False' )
+        atLeast = intParam( query['atLeast'], 'atLeast' ) if 'atLeast' in query else None
+
+        shows = await self.call( engine.recommend, user, n, excludeRated, atLeast )
+        if shows is None:
+            raise requestError( HTTPStatus.NOT_FOUND, 'Unknown user' )
+        return HTTPStatus.OK, { 'user': user, 'shows': [{ 'title': title, 'value': value } for title, value in shows] }
+
+    async def latencies( self, query ):
+
+        return HTTPStatus.OK, self.registry.snapshot()['latencies']
+
+# Splits the request line of a request head into the method and the target.
+def parseRequestLine( head ):
+
+    parts = head.split( b'\r\n', 1 )[0].decode( 'latin-1' ).split()
+    if len( parts ) != 3 or not parts[2].startswith( 'HTTP/' ):
+        raise requestError( HTTPStatus.BAD_REQUEST, 'Malformed request line' )
+    return parts[0], parts[1]
+
+# Whether the connection can stay open after answering a request: by default in HTTP/1.1 unless the client sends
+# "Connection: close", only with "Connection: keep-alive" in HTTP/1.0. A request with a body (which a GET should not
+# have, and is not read) closes it, so that the body is never taken for the next request.
+def keepAliveRequested( head ):
+
+    lines = head.decode( 'latin-1' ).split( '\r\n' )
+    headers = {}
+    for line in lines[1:]:
+
+        name, separator, value = line.partition( ':' )
+        if separator:
+            headers[name.strip().lower()] = value.strip().lower()
+
+    if headers.get( 'content-length', '0' ) != '0' or 'transfer-encoding' in headers:
+        return False
+    connection = { token.strip() for token in headers.get( 'connection', '' ).split( ',' ) }
+    if lines[0].split()[-1] == 'HTTP/1.0':
+        return 'keep-alive' in connection
+    return 'close' not in connection
+
+# The values of the given query parameters, in order. Missing ones are a 400 error.
+def requireParams( query, *names ):
+
+    missing = [name for name in names if not query.get( name )]
+    if missing:
+        raise requestError( HTTPStatus.BAD_REQUEST, 'Missing parameters: %s' % ', '.join( missing ) )
+    return [query[name] for name in names]
+
+def intParam( value, name ):
+
+    try:
+        return int( value )
+    except ValueError:
+        raise requestError( HTTPStatus.BAD_REQUEST, '%s must be an integer' % name )
+
+# Runs a predictionServer in a worker process, on the listening socket shared by every worker.
+def runWorker( sock, modelPath, timeout, cacheSize ):
+
+    server = predictionServer( modelPath, timeout, cacheSize )
+    try:
+        asyncio.run( server.serve( sock = sock ) )
+    except KeyboardInterrupt:
+        pass
+
+# Serves from several worker processes that accept connections on the same listening socket, until interrupted.
+#
+# Parameters:
+# - workers: The number of worker processes.
+# - host, port: The address to listen on.
+# Other parameters are those of predictionServer.
+def serveWorkers( workers, host, port, modelPath, timeout=1.0, cacheSize=1024 ):
+
+    sock = socket.create_server( ( host, port ), backlog = 1024 )
+    processes = [multiprocessing.Process( target = runWorker, args = ( sock, modelPath, timeout, cacheSize ), daemon = True )
+                 for _ in range( workers )]
+    try:
+        for process in processes:
+
+            process.start()
+
+        print( 'Serving on %s with %d workers' % ( str( sock.getsockname() ), workers ) )
+        for process in processes:
+
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        sock.close()
+
+def main( argv=None ):
+
+    parser = argparse.ArgumentParser( description = 'Serves score predictions from a saved model over HTTP.' )
+    parser.add_argument( 'model', help = 'model directory written by engine.saveModel' )
+    parser.add_argument( '--host', default = '127.0.0.1' )
+    parser.add_argument( '--port', type = int, default = 8080 )
+    parser.add_argument( '--timeout', type = float, default = 1.0, help = 'seconds before a request is answered with 504' )
+    parser.add_argument( '--cache-size', type = int, default = 1024, help = 'users to cache the tag marginals of, 0 to disable' )
+    parser.add_argument( '--workers', type = int, default = 1, help = 'number of worker processes sharing the port' )
+    args = parser.parse_args( argv )
+
+    if args.workers > 1:
+        serveWorkers( args.workers, args.host, args.port, args.model, args.timeout, args.cache_size )
+        return
+
+    server = predictionServer( args.model, args.timeout, args.cache_size )
+    try:
+        asyncio.run( server.serve( args.host, args.port ) )
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()